@@ -0,0 +1,85 @@
+# On-disk cache of preparsed corpora, so that reruns on the same files needn't parse them again
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+
+import utils
+from hmm import _common as common
+from hmm.corpus import Corpus
+from hmm.persist import _packStrings, _unpackStrings
+
+FORMAT_VERSION = 1 # bump this whenever the layout of a cached corpus changes
+HASH_BLOCK_SIZE = 1 << 20 # bytes of a file hashed at a time
+
+""" Return the key of a corpus in the cache: a hash of the contents of its files, and of
+     how they are parsed (the preparser, the unker, and whether tags are kept).
+"""
+def corpusKey(files, PreparserClass, UnkerClass, tagged):
+  h = hashlib.sha1()
+  h.update("%i %s %s %s\n" % (FORMAT_VERSION, PreparserClass.__name__, UnkerClass.__name__, tagged))
+  for fname in files:
+    f = open(fname, 'rb')
+    for block in iter(lambda: f.read(HASH_BLOCK_SIZE), ""):
+      h.update(block)
+    f.close()
+    h.update("\0") # the boundary between files is part of the corpus too
+
+  return h.hexdigest()
+
+""" Parse the files of a corpus with PreparserClass into a Corpus (in memory).
+    Raises ValueError if tagged and a sentence is badly formatted, as the preparser does.
+"""
+def encodeCorpus(files, PreparserClass, tagged=True):
+  return PreparserClass(utils.CorpusReader(files)).parseCorpus(tagged)
+
+""" Save a Corpus to the directory path, as .npy files that loadCorpus() can memory-map.
+    The directory is written elsewhere then moved into place, so that it is never seen half written.
+"""
+def saveCorpus(corpus, path):
+  arrays = {"version": np.array(FORMAT_VERSION), "tokens": corpus.getOrigs(), "offsets": corpus.getOffsets()}
+  arrays["words"], arrays["wordOffsets"] = _packStrings(list(corpus.getVocabulary()))
+  if corpus.isTagged():
+    arrays["tags"] = corpus.getTags()
+    arrays["tagNames"], arrays["tagNameOffsets"] = _packStrings(list(corpus.getTagVocabulary()))
+
+  parent = os.path.dirname(os.path.abspath(path))
+  if not os.path.isdir(parent):
+    os.makedirs(parent)
+  tmp = tempfile.mkdtemp(dir=parent)
+  for name,arr in arrays.iteritems():
+    np.save(os.path.join(tmp, name + ".npy"), arr)
+
+  try:
+    os.rename(tmp, path)
+  except OSError: # another process cached the same corpus first
+    shutil.rmtree(tmp)
+
+""" Load a Corpus saved by saveCorpus() from the directory path.
+    If mmap (default), the token and tag arrays are memory-mapped rather than read into memory.
+"""
+def loadCorpus(path, mmap=True):
+  mode = "r" if mmap else None
+  load = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mode)
+
+  if int(load("version")) != FORMAT_VERSION:
+    raise ValueError("%s: unsupported cached corpus version" % path)
+
+  tags = tagVocab = None
+  if os.path.isfile(os.path.join(path, "tags.npy")):
+    tags = load("tags")
+    tagVocab = common.Vocabulary(_unpackStrings(load("tagNames"), load("tagNameOffsets")))
+
+  vocab = common.Vocabulary(_unpackStrings(load("words"), load("wordOffsets")))
+  return Corpus(vocab, load("offsets"), load("tokens"), tagVocab, tags)
+
+""" Return the corpus of the given files as a Corpus, from the cache directory cacheDir
+     if these files were already parsed the same way, otherwise parsing them and caching the result.
+"""
+def cachedCorpus(files, PreparserClass, UnkerClass, cacheDir, tagged=True):
+  path = os.path.join(cacheDir, corpusKey(files, PreparserClass, UnkerClass, tagged))
+  if not os.path.isdir(path):
+    saveCorpus(encodeCorpus(files, PreparserClass, tagged), path)
+
+  return loadCorpus(path)
@@ -0,0 +1,61 @@
+# Cross-validation of a VisibleDataHMM, without retraining it for every fold
+import itertools
+import multiprocessing
+import numpy as np
+
+from decoder import ViterbiDecoder
+
+DFLT_CHUNKS_PER_JOB = 8 # folds are sent to workers in about this many chunks per worker
+
+# Cross-validation state of a worker process, set once per process by _initFoldWorker()
+_workerState = None
+
+""" Pool initializer: workers are forked, so the model and sentences are inherited rather than pickled """
+def _initFoldWorker(model, sentences):
+  global _workerState
+  _workerState = (model, sentences)
+
+""" Decode the sentences of a fold (by index) with the model trained on every other fold.
+    Return: (fold, tags) where tags[k] are the tags of sentence fold[k]
+"""
+def _decodeFold(fold):
+  model, sentences = _workerState
+  viterbi = ViterbiDecoder(model.holdOut(fold))
+  return fold, viterbi.decodeBatch([sentences[s] for s in fold])
+
+""" Split n sentences into k folds of consecutive sentences (as arrays of indices), sizes
+     differing by at most one. k=n is leave-one-out.
+"""
+def makeFolds(n, k):
+  if not 1 < k <= n:
+    raise ValueError("Number of folds must be between 2 and %i (the number of sentences)" % n)
+  return np.array_split(np.arange(n), k)
+
+""" Cross-validate a trained VisibleDataHMM, decoding each fold with the model trained on the
+     others, see VisibleDataHMM.holdOut().
+      model: a VisibleDataHMM, trained on every sentence
+      sentences: the words of every sentence (as lists), to be decoded, in the order of the model's corpus
+      folds: a list of arrays of sentence indices, e.g. from makeFolds()
+      jobs: number of worker processes to decode folds on (default is 1)
+    Return: the decoded tags of every sentence, in order
+"""
+def crossValidate(model, sentences, folds, jobs=1):
+  model.prepareHoldOut() # once, before workers are forked
+  if jobs > 1:
+    pool = multiprocessing.Pool(jobs, _initFoldWorker, (model, sentences))
+    chunkSize = max(1, len(folds)//(jobs*DFLT_CHUNKS_PER_JOB)) # e.g. leave-one-out has many tiny folds
+    results = pool.imap_unordered(_decodeFold, folds, chunkSize)
+  else:
+    _initFoldWorker(model, sentences)
+    results = itertools.imap(_decodeFold, folds)
+
+  decoded = [None]*len(sentences)
+  for fold,tagged in results:
+    for s,tags in itertools.izip(fold, tagged):
+      decoded[s] = tags
+
+  if jobs > 1:
+    pool.close()
+    pool.join()
+
+  return decoded
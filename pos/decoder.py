@@ -1,42 +1,214 @@
 # Hidden Markov Model decoders
 import sys
+import itertools
+import numpy as np
 from hmm import STOP
 
+DFLT_BATCH_SIZE = 64 # max number of sentences decoded together in one lattice
+# a pruned step over more than this fraction of the T x T transitions is run dense, since
+#  broadcasting over all of them beats gathering the few it needs:
+DENSE_STEP_FRACTION = 0.25
+
 class ViterbiDecoder:
 
-  """ Construct the decoder by passing a hidden markov model. """
-  def __init__(self, hmm):
+  """ Construct the decoder by passing a hidden markov model, and optionally, to prune the lattice:
+        tagDict: a hmm.TagDictionary, to restrict the states of each word to its candidate labels.
+                 Its labels must be the model's, e.g. built from the visible model that a
+                 semi-supervised model was trained from.
+        beam: at each word, carry only the beam best states forward
+        threshold: at each word, drop the states whose log score is more than threshold below the best
+      Without any of these, every state of every word is scored, and decoding is exact.
+  """
+  def __init__(self, hmm, tagDict=None, beam=None, threshold=None):
     self.hmm = hmm
 
+    # invert the model's mapping of str y -> int i, so lattice indices map back to labels
+    labelHash = hmm.getLabelHash()
+    self._labels = [None]*len(labelHash)
+    for y,i in labelHash.iteritems():
+      self._labels[i] = y
+    self._numStates = len(self._labels)
+    self._STOPTAG = labelHash[STOP]
+
+    sigma,_ = hmm.getDistribution()
+    self._logSigma = self._log(sigma) # [y,y'] -> log proba
+
+    if tagDict is not None and tagDict.getLabelHash() != labelHash:
+      raise ValueError("The labels of the tag dictionary are not those of the model")
+    self._tagDict = tagDict
+    self._beam = beam
+    self._threshold = threshold
+    self._allStates = np.arange(self._numStates) # the candidates of every word, without tagDict
+    pruned = tagDict is not None or beam is not None or threshold is not None
+    self._decodeBucketOf = self._decodePrunedBucket if pruned else self._decodeBucket
+
+  """ Elementwise log of an array of probabilities, where log(0) = -inf """
+  @staticmethod
+  def _log(probs):
+    with np.errstate(divide='ignore'):
+      return np.log(probs)
+
   """ Decode a given sentence (as a list)
-      
+
+      Runs the Viterbi recursion over the full lattice in log space, one (T x T)
+       max-plus step per word, then follows the backpointers from the final STOP.
       Returns a sequence of part of speech tags for the input sentence
   """
   def decode(self, sentence):
-    decoded = []
+    return self._decodeBucketOf([sentence])[0]
 
-    n = len(sentence)
+  """ Decode many sentences (each a list) at once.
 
-    prev_mu = 1.0
-    yprime = STOP
-    states = self.hmm.getLabels()
-    for i in xrange(0,n): # iterate over the sentence
-      word = sentence[i]
+      Sentences are sorted by length and grouped into buckets of at most batchSize,
+       so that each bucket shares one padded (batch x T x T) lattice with little padding.
+      Returns the sequences of tags, in the same order as the input sentences.
+  """
+  def decodeBatch(self, sentences, batchSize=DFLT_BATCH_SIZE):
+    sentences = list(sentences)
+    decoded = [None]*len(sentences)
 
-      argmax = (None, 0.0)
-      for y in states: # argmax over every possible state y
-        _, maxmu = argmax
-        mu = prev_mu*self.hmm.getSigma(yprime,y)*self.hmm.getTau(y,word)
+    order = sorted(xrange(len(sentences)), key=lambda s: len(sentences[s]))
+    for start in xrange(0, len(order), batchSize):
+      bucket = order[start:start+batchSize]
+      tagged = self._decodeBucketOf([sentences[s] for s in bucket])
+      for s,tags in itertools.izip(bucket, tagged):
+        decoded[s] = tags
 
-        if mu >= maxmu:
-          argmax = (y,mu)
+    return decoded
 
-      # Update step:
-      maxy, maxmu = argmax
+  """ Run the Viterbi recursion over a bucket of sentences padded to the longest one.
+      Padded timesteps carry each state forward unchanged (an identity backpointer),
+       so a shorter sentence's final scores are those at its own last word.
+  """
+  def _decodeBucket(self, sentences):
+    lengths = np.array([len(sentence) for sentence in sentences])
+    B, n, T = len(sentences), max(lengths.max(), 1), self._numStates
 
-      prev_mu = maxmu # update prev_mu
-      yprime = maxy # update yprime
-      decoded.append(maxy) # build decoded sequence
+    logTaus = np.ones([B, n, T]) # [b,i,y] -> log tau_{y,x_i} of sentence b (padding: log 1 = 0)
+    for b,sentence in enumerate(sentences):
+      for i,x in enumerate(sentence):
+        logTaus[b,i] = self.hmm.getTauVector(x) # (the model caches these by word)
+    logTaus = self._log(logTaus) # in one pass over the bucket
 
-    return decoded
+    states = np.arange(T)
+    backptrs = np.empty([B, n, T], dtype=np.intp) # [b,i,y'] -> best y at i-1
+    backptrs[:] = states
+
+    # every sentence begins in the STOP state:
+    mu = self._logSigma[self._STOPTAG,:] + logTaus[:,0,:]
+    for i in xrange(1,n): # iterate over the (padded) sentences
+      active = lengths > i
+      scores = mu[active,:,np.newaxis] + self._logSigma # [b,y,y'] -> log mu(y) + log sigma_{y,y'}
+      backptrs[active,i,:] = np.argmax(scores, axis=1)
+      mu[active] = np.max(scores, axis=1) + logTaus[active,i,:]
+
+    # ...and ends by transitioning back into STOP:
+    y = np.argmax(mu + self._logSigma[:,self._STOPTAG], axis=1)
+
+    best = np.empty([B, n], dtype=np.intp)
+    batch = np.arange(B)
+    for i in xrange(n-1, -1, -1): # follow the backpointers
+      best[:,i] = y
+      y = backptrs[batch,i,y]
+
+    return [[self._labels[y] for y in best[b,:lengths[b]]] for b in xrange(B)]
+
+  """ Run the Viterbi recursion over a bucket of sentences, as _decodeBucket() does, but over
+       only the candidate states of each word: those of the tag dictionary (or every state),
+       padded to the most candidates of any word at the same position in the bucket. Each step
+       is then a (batch x K x K') max-plus, or (batch x beam x K') with a beam, rather than
+       (batch x T x T).
+      Lattice indices are positions in each word's candidates, mapped back to labels at the end.
+  """
+  def _decodePrunedBucket(self, sentences):
+    lengths = np.array([len(sentence) for sentence in sentences])
+    B, n = len(sentences), max(lengths.max(), 1)
+
+    if self._tagDict is not None:
+      candidates = [[self._tagDict.getCandidates(x) for x in sentence] for sentence in sentences]
+      K = max([len(c) for sentence in candidates for c in sentence] or [1])
+    else:
+      candidates = [[self._allStates]*len(sentence) for sentence in sentences]
+      K = self._numStates
+
+    cand = np.empty([B, n, K], dtype=np.intp) # [b,i,k] -> label of the kth candidate of word i
+    cand[:] = self._STOPTAG
+    numCands = np.ones([B, n], dtype=np.intp) # [b,i] -> num. of candidates of word i
+    taus = np.zeros([B, n, K]) # [b,i,k] -> tau of the kth candidate (padding: tau 0, i.e. never chosen)
+    for b,sentence in enumerate(sentences):
+      for i,x in enumerate(sentence):
+        c = candidates[b][i]
+        cand[b,i,:len(c)] = c
+        cand[b,i,len(c):] = c[0]
+        numCands[b,i] = len(c)
+        taus[b,i,:len(c)] = self.hmm.getTauVector(x)[c]
+      if 0 < lengths[b] < n: # padded timesteps keep the candidates of the last word
+        cand[b,lengths[b]:] = cand[b,lengths[b]-1]
+        numCands[b,lengths[b]:] = numCands[b,lengths[b]-1]
+    logTaus = self._log(taus)
+
+    backptrs = np.empty([B, n, K], dtype=np.intp) # [b,i,k] -> best candidate at i-1
+    backptrs[:] = np.arange(K)
+
+    # every sentence begins in the STOP state:
+    mu = self._prune(self._logSigma[self._STOPTAG][cand[:,0,:]] + logTaus[:,0,:])
+    for i in xrange(1,n):
+      # step the sentences of similar numbers of candidates together, so that one word with
+      #  many candidates (e.g. an unseen word) widens the step of its own sentence only:
+      active = np.flatnonzero(lengths > i)
+      width = numCands[active,i-1]*numCands[active,i]
+      widthClass = np.ceil(np.log2(width)/2).astype(np.intp) # within a factor 2 of each other, per word
+      for c in np.unique(widthClass):
+        self._prunedStep(i, active[widthClass == c], cand, numCands, mu, logTaus, backptrs)
+
+    # ...and ends by transitioning back into STOP:
+    batch = np.arange(B)
+    k = np.argmax(mu + self._logSigma[cand[:,n-1,:], self._STOPTAG], axis=1)
+
+    best = np.empty([B, n], dtype=np.intp)
+    for i in xrange(n-1, -1, -1): # follow the backpointers
+      best[:,i] = cand[batch,i,k]
+      k = backptrs[batch,i,k]
+
+    return [[self._labels[y] for y in best[b,:lengths[b]]] for b in xrange(B)]
+
+  """ Step the pruned recursion of _decodePrunedBucket() to word i, for the sentences bs of the bucket,
+       updating their mu and backpointers in place
+  """
+  def _prunedStep(self, i, bs, cand, numCands, mu, logTaus, backptrs):
+    T = self._logSigma.shape[1]
+    rows = np.arange(len(bs))[:,np.newaxis]
+    prevK, currK = numCands[bs,i-1].max(), numCands[bs,i].max() # candidates beyond are padding
+    prev, m = cand[bs,i-1,:prevK], mu[bs,:prevK]
+    keep = None
+    if self._beam is not None and self._beam < prevK: # only the beam best states go on
+      keep = np.argpartition(-m, self._beam-1, axis=1)[:,:self._beam]
+      prev, m = prev[rows,keep], m[rows,keep]
+
+    fromK = keep if keep is not None else np.arange(prevK)[np.newaxis,:].repeat(len(bs), axis=0)
+    curr = cand[bs,i,:currK]
+    nextMu = np.full([len(bs), mu.shape[1]], -np.inf)
+    if prev.shape[1]*currK > DENSE_STEP_FRACTION*T*T:
+      # scatter the (real, not padding) candidates into every state, and step over all of them:
+      r,j = np.nonzero(fromK < numCands[bs,i-1][:,np.newaxis])
+      full = np.full([len(bs), T], -np.inf)
+      full[r,prev[r,j]] = m[r,j]
+      index = np.zeros([len(bs), T], dtype=np.intp) # [b,y] -> candidate index of y at i-1
+      index[r,prev[r,j]] = fromK[r,j]
+      scores = full[:,:,np.newaxis] + self._logSigma # [b,y,y'] -> log mu(y) + log sigma_{y,y'}
+      best = np.argmax(scores, axis=1)[rows,curr]
+      backptrs[bs,i,:currK] = index[rows,best]
+      nextMu[:,:currK] = np.max(scores, axis=1)[rows,curr]
+    else:
+      # [b,k,k'] -> log mu(k) + log sigma_{y_k,y_k'}:
+      scores = m[:,:,np.newaxis] + self._logSigma.ravel().take(prev[:,:,np.newaxis]*T + curr[:,np.newaxis,:])
+      backptrs[bs,i,:currK] = fromK[rows,np.argmax(scores, axis=1)]
+      nextMu[:,:currK] = np.max(scores, axis=1)
+    nextMu[:,:currK] += logTaus[bs,i,:currK]
+    mu[bs] = self._prune(nextMu)
 
+  """ Drop (to -inf) the log scores of each row more than the threshold below the row's best, in place """
+  def _prune(self, mu):
+    if self._threshold is not None:
+      mu[mu < mu.max(axis=1)[:,np.newaxis] - self._threshold] = -np.inf
+    return mu
@@ -2,8 +2,11 @@
 STOP = "0" # STOP tag
 UNK = "*UNK*" # unknown word
 
-__all__ = ["visible", "hidden"]
+__all__ = ["visible", "hidden", "persist", "corpus", "metrics", "tagdict"]
 
 from hidden import HiddenDataHMM
 from visible import VisibleDataHMM
+from persist import saveModel, loadModel, saveCheckpoint, loadCheckpoint
+from corpus import Corpus
+from tagdict import TagDictionary
 
@@ -1,3 +1,7 @@
+import collections
+import numpy as np
+
+DFLT_CACHE_SIZE = 4096 # default number of emission vectors an HMM caches
 
 """Map the association between a pos label and its integer index.
    Necessary because hmms store labels as ints for faster indexing on numpy arrays,
@@ -10,19 +14,94 @@ def makeLabelHash(labels):
 
  return labelHash
 
-""" A subclass of a dict that overrides __missing__ """
-class TauDict(dict):
+""" Maps each distinct word to a contiguous int id, in the order the words were first seen.
+    Necessary because hmms store emissions as a (labels x words) numpy array, so an id
+     is the column of a word in that array.
+"""
+class Vocabulary:
+
+  """ words: (optional) an iterable of words to add, e.g. another Vocabulary to extend """
+  def __init__(self, words=()):
+    self._ids = {} # str word -> int id
+    self._words = [] # int id -> str word
+    for word in words:
+      self.add(word)
+
+  """ Return the id of a word, adding it to the vocabulary if it is new """
+  def add(self, word):
+    i = self._ids.get(word)
+    if i is None:
+      i = len(self._words)
+      self._ids[word] = i
+      self._words.append(word)
+
+    return i
+
+  """ Return the ids of a sentence (as a list of words), adding any new words """
+  def encode(self, sentence):
+    return np.array([self.add(word) for word in sentence], dtype=np.int32)
+
+  """ Return the id of a word, or None if the word is not in the vocabulary """
+  def getId(self, word):
+    return self._ids.get(word)
+
+  """ Return the word with the given id """
+  def getWord(self, i):
+    return self._words[i]
+
+  def __len__(self):
+    return len(self._words)
+
+  def __contains__(self, word):
+    return word in self._ids
+
+  def __iter__(self):
+    return iter(self._words)
+
+""" Return tau_{y,x} for every label y of a word x, as an HMM's getTauVector() does: the
+     column of tau of the UNKed x, given by tauOfColumn(id of x in vocab), or smooth if x is
+     not in vocab. Cached in cache by the UNKed x, so that each word is evaluated only once.
+"""
+def cachedTauVector(x, unker, vocab, cache, smooth, tauOfColumn):
+  x = unker.evaluateWord(x) # evaluate x only once for all labels
+  tau = cache.get(x)
+  if tau is None:
+    column = vocab.getId(x)
+    tau = smooth if column is None else tauOfColumn(column)
+    cache.put(x, tau)
+  return tau
+
+""" A mapping of bounded size, which evicts its least recently used key when full.
+    Counts the hits and misses of get(), e.g. to tune the size.
+"""
+class LRUCache:
+
+  def __init__(self, size=DFLT_CACHE_SIZE):
+    self._size = size
+    self._items = collections.OrderedDict() # in order of use, most recent last
+    self.hits = 0
+    self.misses = 0
+
+  """ Return the value of key, or None if it isn't cached """
+  def get(self, key):
+    value = self._items.pop(key, None)
+    if value is None:
+      self.misses += 1
+      return None
+
+    self._items[key] = value # now the most recently used
+    self.hits += 1
+    return value
 
-  """ n_ycirc: counts the times a label y maps to any output (n_ycirc :: int -> Number)
-      wordCount: an integer/float of the total number of words in the corpus
-  """
-  def __init__(self, alpha, n_ycirc, wordCount):
-    self._alpha = alpha
-    self._n_ycirc = n_ycirc
-    self._wc = wordCount
+  def put(self, key, value):
+    self._items[key] = value
+    if len(self._items) > self._size:
+      self._items.popitem(last=False)
 
-  """ Override dict's __missing__ for smoothing taus """
-  def __missing__(self, key):
-    y,_ = key
-    return self._alpha/(self._n_ycirc[y] + self._alpha*self._wc)
+  """ Forget every value, e.g. when the values are invalidated. The counts are kept. """
+  def clear(self):
+    self._items.clear()
 
+  """ Return the number of (hits, misses) so far """
+  def getStats(self):
+    return (self.hits, self.misses)
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import numpy as np
+
+from . import _common as common
+
+DFLT_COUNT_CHUNK = 4096 # sentences of a StreamedCorpus counted at a time
+
+""" Return the indices start[k], start[k]+1, ..., start[k]+lengths[k]-1 of every k, end to end """
+def ranges(starts, lengths):
+  total = lengths.sum()
+  return np.arange(total, dtype=np.int64) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+
+""" A corpus of sentences, kept as flat arrays rather than as lists of lists of strings:
+     the (original) word ids of every sentence end to end, optionally the tag ids of those words
+     and the ids of their UNKed forms, and the offset of each sentence in these arrays,
+     i.e. sentence s is origs[offsets[s]:offsets[s+1]].
+    Word ids index a Vocabulary, tag ids another. The preparser builds a Corpus, which the unker
+     and the HMMs then share, so that each token of the corpus is kept once, as a few ints.
+"""
+class Corpus:
+
+  """ vocab: a Vocabulary of the words (which may go on to be extended, e.g. with UNK categories)
+      offsets: int array of n+1 offsets of the n sentences
+      origs: int32 array of word ids
+      tagVocab, tags: (optional) a Vocabulary of the tags, and int32 array of tag ids
+      unked: (optional) int32 array of the ids of the words' UNKed forms, see withUnked()
+  """
+  def __init__(self, vocab, offsets, origs, tagVocab=None, tags=None, unked=None):
+    self._vocab = vocab
+    self._offsets = offsets
+    self._origs = origs
+    self._tagVocab = tagVocab
+    self._tags = tags
+    self._unked = unked
+
+  """ Encode sentences (each a list of words) and optionally their tags (each a list of tags)
+       as a Corpus. Either can be any iterable, e.g. streaming from disk; each is read once.
+      Raises ValueError if there are tags, but not as many as sentences.
+  """
+  @staticmethod
+  def fromSentences(sentences, tags=None):
+    if tags is None:
+      return Corpus.fromWordsTags((words, None) for words in sentences)
+
+    def pairs():
+      for words,labels in itertools.izip_longest(sentences, tags):
+        if words is None or labels is None: # problem
+          raise ValueError("Outputs and labels should be the same size")
+        yield words,labels
+
+    return Corpus.fromWordsTags(pairs())
+
+  """ Encode (words, tags) pairs of sentences as a Corpus, e.g. from a preparser's iterWordsTags().
+      If the tags of the first pair are None, the corpus has no tags.
+  """
+  @staticmethod
+  def fromWordsTags(pairs):
+    vocab, tagVocab = common.Vocabulary(), common.Vocabulary()
+    origs, tags, lengths = [], [], [0]
+    tagged = None
+    for words,labels in pairs:
+      if tagged is None:
+        tagged = labels is not None
+      origs.append(vocab.encode(words))
+      if tagged:
+        tags.append(tagVocab.encode(labels))
+      lengths.append(len(words))
+
+    concat = lambda arrays: np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int32)
+    offsets = np.cumsum(lengths, dtype=np.int64)
+    if not tagged:
+      return Corpus(vocab, offsets, concat(origs))
+    return Corpus(vocab, offsets, concat(origs), tagVocab, concat(tags))
+
+  """ Return a Corpus of the same sentences, with the ids in vocab of their words' UNKed forms
+       as given by unker (see AbstractUnker.unkIds), adding UNK categories to vocab as needed.
+      The arrays of this corpus are shared, not copied.
+  """
+  def withUnked(self, unker, vocab):
+    # each distinct word is UNKed once, and only the words of this corpus, which may be a slice:
+    present = np.flatnonzero(np.bincount(self._origs, minlength=len(self._vocab)))
+    unked = np.zeros(len(self._vocab), dtype=np.int32)
+    unked[present] = unker.unkIds([self._vocab.getWord(x) for x in present], vocab)
+    return Corpus(self._vocab, self._offsets, self._origs, self._tagVocab, self._tags, unked[self._origs])
+
+  """ Return the number of sentences """
+  def __len__(self):
+    return len(self._offsets)-1
+
+  """ Return the number of words, over all sentences """
+  def numTokens(self):
+    return int(self._offsets[-1])
+
+  """ Return True if the corpus has tags """
+  def isTagged(self):
+    return self._tags is not None
+
+  def getVocabulary(self):
+    return self._vocab
+
+  def getTagVocabulary(self):
+    return self._tagVocab
+
+  def getOffsets(self):
+    return self._offsets
+
+  """ Return the word ids of every sentence, end to end """
+  def getOrigs(self):
+    return self._origs
+
+  """ Return the tag ids of every sentence, end to end (or None if untagged) """
+  def getTags(self):
+    return self._tags
+
+  """ Return the UNKed word ids of every sentence, end to end (or None if not UNKed) """
+  def getUnked(self):
+    return self._unked
+
+  """ Return the word ids of sentence s """
+  def getSentence(self, s):
+    return self._origs[self._offsets[s]:self._offsets[s+1]]
+
+  """ Return the UNKed word ids of the sentences [start,end), as a list of arrays """
+  def getUnkedSentences(self, start, end):
+    offsets = self._offsets
+    return [self._unked[offsets[s]:offsets[s+1]] for s in xrange(start, end)]
+
+  """ Return the original word found in the jth position of the ith sentence """
+  def getOrigWord(self, i, j):
+    return self._vocab.getWord(self._origs[self._offsets[i]+j])
+
+  """ Return the positions (in the flat arrays) of every word of the given sentences (by index),
+       or only of the words that are followed by another in the same sentence if transitions
+  """
+  def positions(self, sentences=None, transitions=False):
+    offsets = self._offsets
+    if sentences is None:
+      starts, lengths = offsets[:-1], np.diff(offsets)
+    else:
+      sentences = np.asarray(sentences)
+      starts, lengths = offsets[sentences], offsets[sentences+1] - offsets[sentences]
+    if transitions:
+      lengths = np.maximum(lengths-1, 0)
+
+    return ranges(starts, lengths)
+
+  """ Return (counts, n) where counts maps each word to its count, and n is the number of words,
+       as utils.buildCounts() does
+  """
+  def getCounts(self):
+    counts = np.bincount(self._origs, minlength=len(self._vocab))
+    nonzero = np.flatnonzero(counts)
+    return dict(itertools.izip([self._vocab.getWord(x) for x in nonzero], counts[nonzero].tolist())), self.numTokens()
+
+  """ Return the words of sentence s as a list, or a Corpus of the sentences of a slice
+       (sharing this corpus' arrays), e.g. corpus[:1000] for the first 1000 sentences
+  """
+  def __getitem__(self, s):
+    if isinstance(s, slice):
+      start, end, step = s.indices(len(self))
+      if step != 1:
+        raise ValueError("Corpus slices must be contiguous")
+      end = max(start, end)
+      first, last = self._offsets[start], self._offsets[end]
+      section = lambda arr: arr[first:last] if arr is not None else None
+      return Corpus(self._vocab, self._offsets[start:end+1] - first, section(self._origs),
+                    self._tagVocab, section(self._tags), section(self._unked))
+
+    words = self._vocab.getWord
+    return [words(x) for x in self.getSentence(s)]
+
+  def __getslice__(self, start, end): # python 2 calls this for corpus[a:b]
+    return self.__getitem__(slice(start, end))
+
+  """ Iterate over the sentences, each as a list of words, like a preparser's iterWords() """
+  def __iter__(self):
+    return self.iterWords()
+
+  def iterWords(self):
+    words, origs, offsets = self._vocab.getWord, self._origs, self._offsets
+    for s in xrange(len(self)):
+      yield [words(x) for x in origs[offsets[s]:offsets[s+1]]]
+
+  """ Iterate over the tags of each sentence, each as a list """
+  def iterTags(self):
+    tags, ids, offsets = self._tagVocab.getWord, self._tags, self._offsets
+    for s in xrange(len(self)):
+      yield [tags(y) for y in ids[offsets[s]:offsets[s+1]]]
+
+  """ Iterate over the (words, tags) of each sentence, like a preparser's iterWordsTags() """
+  def iterWordsTags(self):
+    return itertools.izip(self.iterWords(), self.iterTags())
+
+""" A corpus of sentences streamed from files rather than held in memory, for online EM: each
+     pass over it parses the files again, with the preparser's parseFile(), into arrays of word
+     ids. Word ids index a Vocabulary which grows as new words are read, so is complete after
+     the first pass (e.g. counting the corpus with getCounts()).
+"""
+class StreamedCorpus:
+
+  """ files: the paths of the corpus, untagged
+      PreparserClass: the preparser of the corpus' format
+  """
+  def __init__(self, files, PreparserClass):
+    self._files = files
+    self._preparser = PreparserClass
+    self._vocab = common.Vocabulary()
+    self._n_sentences = None # counted on the first pass of getCounts()
+
+  def getVocabulary(self):
+    return self._vocab
+
+  """ Iterate over the sentences, each as an array of word ids, parsing the files again """
+  def iterIds(self):
+    return self._preparser.parseFile(self._files, self._vocab)
+
+  """ Return (counts, n) where counts maps each word to its count, and n is the number of words,
+       as utils.buildCounts() does, counting the ids of a chunk of sentences at a time
+  """
+  def getCounts(self):
+    counts = np.zeros(0, dtype=np.int64)
+    sentences = self.iterIds()
+    n_sentences = 0
+    while True:
+      chunk = list(itertools.islice(sentences, DFLT_COUNT_CHUNK))
+      if not chunk:
+        break
+      n_sentences += len(chunk)
+      chunkCounts = np.bincount(np.concatenate(chunk), minlength=len(self._vocab))
+      chunkCounts[:len(counts)] += counts # the vocabulary only grows, so earlier ids keep their place
+      counts = chunkCounts
+
+    self._n_sentences = n_sentences
+    nonzero = np.flatnonzero(counts)
+    return dict(itertools.izip([self._vocab.getWord(x) for x in nonzero], counts[nonzero].tolist())), int(counts.sum())
+
+  """ Return the number of sentences """
+  def __len__(self):
+    if self._n_sentences is None:
+      self._n_sentences = sum(1 for _ in self.iterIds())
+    return self._n_sentences
+
+  """ Iterate over the sentences, each as a list of words, like a preparser's iterWords() """
+  def __iter__(self):
+    words = self._vocab.getWord
+    for ids in self.iterIds():
+      yield [words(x) for x in ids]
@@ -1,23 +1,88 @@
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
+import multiprocessing
 import numpy as np
 import sys
 
 from . import _common as common
+from . import metrics
+from . import persist
 from . import STOP
+from .corpus import Corpus, StreamedCorpus
 
 cimport cython
 cimport numpy as np
 
 #np.set_printoptions(threshold=np.inf)
 
+# Sentences per shard of the E-step. Fixed (rather than derived from the number of workers)
+#  so that the expectations, summed shard by shard, don't depend on how many workers ran.
+DFLT_SHARD_SIZE = 256
+
+# Online (stepwise) EM: sentences per minibatch, and the exponent of the step size
+#  eta_k = (k+1)^-DFLT_STEP_EXPONENT of the k-th update, in (0.5, 1] for convergence
+DFLT_ONLINE_BATCH = 1000
+DFLT_STEP_EXPONENT = 0.7
+
+# Iterations of EM between checkpoints, when checkpointing
+DFLT_CHECKPOINT_EVERY = 1
+
+# The HiddenDataHMM of an E-step worker process, set once per process by _initEStepWorker()
+_workerModel = None
+
+""" Pool initializer: workers are forked, so the model is inherited rather than pickled.
+    The pool serves every iteration of EM, so the model's sigma and tau are replaced with the
+     shared arrays (see _sharedArray()) that the trainer copies each iteration's into.
+"""
+def _initEStepWorker(model, sigma, tau):
+  global _workerModel
+  model._sigma, model._tau = sigma, tau
+  _workerModel = model
+
+""" Return an array of zeros of the given shape in shared memory, which forked workers see
+     the changes of
+"""
+def _sharedArray(shape):
+  return np.frombuffer(multiprocessing.RawArray('d', int(np.prod(shape)))).reshape(shape)
+
+""" Compute the expectations of one shard of the corpus, in a worker process """
+def _shardEStep(shard):
+  return _workerModel.expectShard(*shard)
+
+""" Return the kth largest (from k=1) of values[:m], which are reordered in place (quickselect) """
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _kthLargest(np.ndarray[double] values, int m, int k):
+  cdef int lo = 0, hi = m-1, i, j, target = k-1
+  cdef double pivot, tmp
+  while lo < hi:
+    pivot = values[(lo+hi)//2]
+    i, j = lo, hi
+    while i <= j: # partition into >= pivot, then <= pivot
+      while values[i] > pivot:
+        i += 1
+      while values[j] < pivot:
+        j -= 1
+      if i <= j:
+        tmp = values[i]
+        values[i] = values[j]
+        values[j] = tmp
+        i += 1
+        j -= 1
+    if target <= j:
+      hi = j
+    elif target >= i:
+      lo = i
+    else:
+      break
+  return values[target]
+
 """ A Hidden Markov Model constructed from hidden (unlabeled) data """
 cdef class HiddenDataHMM:
-  cdef public _outputs, _unker, _states, _labelHash, _sigma, _tau, _smooth
-  cdef int _ITER_CAP, _numStates, _wc
+  cdef public _corpus, _unker, _states, _labelHash, _vocab, _observed, _sigma, _tau, _tauSmooth, _tauCache, _unkMap
+  cdef int _ITER_CAP, _numStates, _wc, _n_sentences, _pruneTop
   cdef public int _STOPTAG
-  cdef double _alpha, _WEIGHTCOEF
+  cdef double _alpha, _WEIGHTCOEF, _pruneThreshold
 
   """ Construct the HMM from:
         unker: A subclass inheriting from AbstractUnker
@@ -26,10 +91,36 @@ cdef class HiddenDataHMM:
         labelHash: (optional) maps a string label to an internal int index,
                    required if this HiddenDataHMM is used to supplement a
                    VisibleDataHMM in a semi-supervised fashion.
+        vocab: (optional) a Vocabulary mapping outputs to tau columns, which is
+               copied and extended with this corpus. Required along with labelHash.
+        stream: (optional) if True, don't keep the encoded corpus in memory but
+                re-read it from the unker as it is needed. Only trainOnline() can
+                then be used to train the model.
   """
-  def __init__(self, unker, tagset, wordCount, labelHash=None):
-    # hash to create an array of ints
-    self._outputs = [[hash(x) for x in sentence] for sentence in unker.getUnkedCorpus()]
+  def __init__(self, unker, tagset, wordCount, labelHash=None, vocab=None, stream=False):
+    self._vocab = common.Vocabulary(vocab or ())
+    if stream:
+      # every (UNKed) word of the counts gets a column up front, since the corpus isn't read yet
+      unker.unkIds(unker.getCounts(), self._vocab)
+      self._corpus = None
+      corpus = unker.getOrigCorpus()
+      if isinstance(corpus, StreamedCorpus): # map the ids it streams to those of their UNKed forms
+        self._unkMap = unker.unkIds(corpus.getVocabulary(), self._vocab)
+        self._n_sentences = len(corpus)
+      else:
+        self._n_sentences = sum(1 for _ in corpus)
+      self._observed = np.zeros(len(self._vocab), dtype=bool) # filled in as the corpus is streamed
+    else:
+      # encode the corpus (unless the unker's already is) with the vocabulary ids of its UNKed words
+      corpus = unker.getOrigCorpus()
+      if not isinstance(corpus, Corpus):
+        corpus = Corpus.fromSentences(corpus)
+      with metrics.getMetrics().phase("unk") as phase:
+        self._corpus = corpus.withUnked(unker, self._vocab)
+        phase.count(len(corpus), corpus.numTokens())
+      self._n_sentences = len(self._corpus)
+      self._observed = np.zeros(len(self._vocab), dtype=bool) # which x occur in this corpus
+      self._observed[self._corpus.getUnked()] = True
     self._unker = unker
     self._numStates = len(tagset)
     self._states = range(0, self._numStates) # faster np.array indexing
@@ -43,218 +134,577 @@ cdef class HiddenDataHMM:
     randMat = np.random.uniform(0.9,1.1,[self._numStates]*2)
     self._sigma = np.full([self._numStates]*2, 0.1)*randMat # [y,y']->proba
 
-    # initialise tau as defaultdict with random initialisation (default)
+    # initialise tau as a [y,x] matrix, uniformly smoothed (default)
     self._alpha = 1.0
-    self._smooth = lambda: self._alpha/self._wc
-    self._tau = defaultdict(self._smooth)
+    self._tauSmooth = np.full(self._numStates, self._alpha/self._wc) # also for x not in vocab
+    self._tau = np.repeat(self._tauSmooth[:,np.newaxis], len(self._vocab), axis=1)
+    self._tauCache = common.LRUCache() # UNKed x -> tau_{.,x}, cleared whenever tau changes
 
     # the weight coefficient provides a way to scale how the counts derived
     #  from visible (POS-labeled) data are weighted rel. to the size of the
     #  unlabeled corpus
     self._WEIGHTCOEF = 20.0 # guesstimate
 
-  """ Compute alphas for this timestep.
-        alpha: n x m slice of the alphaBetaMat (n words by m states)
-        x: the output at this timestep
-      Return: Nothing, calculated in place
+    # posterior pruning of the E-step (off), see setPruning():
+    self._pruneThreshold = 0.0
+    self._pruneTop = 0
+
+  """ Compute the scaled forward and backward probabilities of a sentence, in place.
+       The alphas of each timestep i are normalised by their sum, scales[i], and the betas by
+       the same scales, so that neither underflows on long sentences: alphas[i]*betas[i] is then
+       the posterior of each state at i, and the sentence's log probability is sum_i log scales[i].
+        sigma: m x m transition matrix
+        taus: n x m matrix of emission columns, taus[i] = tau_{.,x_i}
+        alphas, betas: n x m slices of the alpha/beta workspace (n words by m states)
+        scales: n slice of the scales workspace
+      Return: the log probability of the sentence, log alpha_STOP(n), or -inf if it is 0
+  """
+  cdef double _forwardBackward(self, np.ndarray[double, ndim=2] sigma, np.ndarray[double, ndim=2] taus,
+                               np.ndarray[double, ndim=2] alphas, np.ndarray[double, ndim=2] betas,
+                               np.ndarray[double] scales):
+    cdef int i, n = taus.shape[0]
+
+    # e.g. [STOP, "hello", "world", STOP] starts and ends in the STOP state
+    alphas[0,:] = 0.0
+    alphas[0,self._STOPTAG] = 1.0
+    scales[0] = 1.0
+    betas[(n-1),:] = 0.0
+    betas[(n-1),self._STOPTAG] = 1.0
+
+    for i in xrange(1,n): # alpha_{y'}(i) = sum_y alpha_y(i-1)*sigma_{y,y'} * tau_{y',x_i}, normalised
+      alphas[i,:] = np.dot(alphas[(i-1)], sigma)*taus[i]
+      if i == n-1: # the sentence ends in STOP only
+        alphas[i,:] = np.where(np.arange(self._numStates) == self._STOPTAG, alphas[i], 0.0)
+      scales[i] = alphas[i].sum()
+      if scales[i] == 0.0:
+        return -np.inf
+      alphas[i,:] /= scales[i]
+    for i in xrange(n-2,-1,-1): # beta_y(i) = sum_{y'} sigma_{y,y'}*tau_{y',x_{i+1}}*beta_{y'}(i+1), as scaled
+      betas[i,:] = np.dot(sigma, taus[(i+1)]*betas[(i+1)])/scales[(i+1)]
+
+    return np.log(scales[:n]).sum()
+
+  """ Prune the forward probabilities of timestep i in place (see setPruning()), zeroing all but
+       the surviving states, which are written in increasing order to survivors[i].
+        scratch: workspace of m doubles
+      Return: the fraction of the timestep's forward mass pruned
   """
   @cython.boundscheck(False)
-  cdef void _computeAlphasTimestep(self, double[:,:] sigma, double[:,:] alpha, int i, long x):
-    cdef double val
-    for y in range(0, self._numStates):
-      val = 0.0
-      for yprime in range(0, self._numStates):
-        val += alpha[(i-1), yprime]*sigma[yprime,y]
-      alpha[i,y] = val*self._tau[(y,x)]
-
-  """ Compute alphas for this timestep.
-        beta: n x m slice of the alphaBetaMat (n words by m states)
-        xNext: the output at next timestep
-      Return: Nothing, calculated in place
+  @cython.wraparound(False)
+  cdef double _prune(self, int i, np.ndarray[double, ndim=2] alphas, np.ndarray[np.intp_t, ndim=2] survivors,
+                     np.ndarray[np.intp_t] numSurvivors, np.ndarray[double] scratch):
+    cdef int y, k = 0, nonzero = 0, above = 0, ties, m = alphas.shape[1]
+    cdef double a, best = 0.0, total = 0.0, kept = 0.0, cutoff, kth
+
+    for y in xrange(m):
+      a = alphas[i,y]
+      if a > 0.0:
+        scratch[nonzero] = a
+        nonzero += 1
+        total += a
+        if a > best:
+          best = a
+
+    # keep what is above the cutoff, and at the cutoff while there are ties to spare:
+    cutoff, ties = self._pruneThreshold*best, m
+    if 0 < self._pruneTop < nonzero:
+      kth = _kthLargest(scratch, nonzero, self._pruneTop)
+      if kth > cutoff:
+        for y in xrange(m):
+          if alphas[i,y] > kth:
+            above += 1
+        cutoff, ties = kth, self._pruneTop - above
+
+    for y in xrange(m):
+      a = alphas[i,y]
+      if a > 0.0 and (a > cutoff or (a == cutoff and ties > 0)):
+        if a == cutoff:
+          ties -= 1
+        survivors[i,k] = y
+        k += 1
+        kept += a
+      else:
+        alphas[i,y] = 0.0
+    numSurvivors[i] = k
+    return 1.0 - kept/total if total > 0.0 else 0.0
+
+  """ Compute the forward and backward probabilities of a sentence as _forwardBackward() does,
+       but over only the states of each timestep that survive pruning of its forward probabilities;
+       the alphas and betas of the others are zero. A forward step then costs (survivors x m)
+       rather than (m x m), and a backward step (survivors x survivors).
+        survivors, numSurvivors: n x m and n workspaces, filled with the survivors of each timestep
+        scratch: workspace of m doubles
+      Return: (the log probability of the sentence over the surviving states, or -inf,
+               the sum over timesteps of the fraction of forward mass pruned)
   """
   @cython.boundscheck(False)
-  cdef void _computeBetasTimestep(self, double[:,:] sigma, double[:,:] beta, int i, long xNext):
-    cdef double val
-    cdef int y, yprime
-    for y in range(0, self._numStates):
-      val = 0.0
-      for yprime in range(0, self._numStates):
-        val += beta[(i+1),yprime]*sigma[y,yprime]*self._tau[(yprime,xNext)]
-      beta[i,y] = val
-
-  """ Normalise alpha_i and beta_i (both row vectors) """
-  @cython.cdivision(True)
-  cdef void _normaliseAlphaBeta(self, np.ndarray[double] alpha_i, np.ndarray[double] beta_i):
-    normFactor = np.sum(alpha_i)
-    alpha_i = alpha_i/normFactor
-    beta_i = beta_i/normFactor
-
-  """ Compute E[n_{i,y,x}|x].
-        alpha_y: alpha_y(i)
-        beta_y: beta_y(i)
-        totalProb: alpha_STOP(n)
+  @cython.wraparound(False)
+  cdef tuple _prunedForwardBackward(self, np.ndarray[double, ndim=2] sigma, np.ndarray[double, ndim=2] taus,
+                                    np.ndarray[double, ndim=2] alphas, np.ndarray[double, ndim=2] betas,
+                                    np.ndarray[np.intp_t, ndim=2] survivors, np.ndarray[np.intp_t] numSurvivors,
+                                    np.ndarray[double] scratch, np.ndarray[double] scales):
+    cdef int i, j, k, y, c, d, n = taus.shape[0], m = sigma.shape[0]
+    cdef double a, beta, scale, prunedMass = 0.0
+
+    alphas[:,:] = 0.0
+    alphas[0,self._STOPTAG] = 1.0
+    scales[0] = 1.0
+    survivors[0,0] = survivors[(n-1),0] = self._STOPTAG # the first and final STOPs aren't pruned
+    numSurvivors[0] = numSurvivors[(n-1)] = 1
+    for i in xrange(1,n): # only the previous survivors contribute to alpha(i)
+      for j in xrange(numSurvivors[(i-1)]):
+        c = survivors[(i-1),j]
+        a = alphas[(i-1),c]
+        for y in xrange(m):
+          alphas[i,y] += a*sigma[c,y]
+      for y in xrange(m):
+        alphas[i,y] *= taus[i,y]
+      if i < n-1:
+        prunedMass += self._prune(i, alphas, survivors, numSurvivors, scratch)
+      else: # the sentence ends in STOP only
+        a = alphas[i,self._STOPTAG]
+        alphas[i,:] = 0.0
+        alphas[i,self._STOPTAG] = a
+
+      scale = 0.0 # normalise, as in _forwardBackward()
+      for j in xrange(numSurvivors[i]):
+        scale += alphas[i,survivors[i,j]]
+      if scale == 0.0:
+        return -np.inf, prunedMass
+      scales[i] = scale
+      for j in xrange(numSurvivors[i]):
+        alphas[i,survivors[i,j]] /= scale
+
+    betas[:,:] = 0.0
+    betas[(n-1),self._STOPTAG] = 1.0
+    for i in xrange(n-2,-1,-1): # and only from the next survivors
+      for j in xrange(numSurvivors[i]):
+        c = survivors[i,j]
+        beta = 0.0
+        for k in xrange(numSurvivors[(i+1)]):
+          d = survivors[(i+1),k]
+          beta += sigma[c,d]*taus[(i+1),d]*betas[(i+1),d]
+        betas[i,c] = beta/scales[(i+1)]
+
+    return np.log(scales[:n]).sum(), prunedMass
+
+  """ Accumulate the expectations of a sentence over only its surviving states, as filled in
+       by _prunedForwardBackward(). Column k of expected_yx is that of the sentence's kth word.
   """
-  @cython.cdivision(True)
-  cdef double _expEmissionFreq(self, double alpha_y, double beta_y, double totalProb):
-    return alpha_y*beta_y/totalProb
-
-  """ Compute E[N_{i,y,y'}|x].
-        alpha_y: alpha_y(i)
-        beta_yprime: beta_{y'}(i+1)
-        sigma: sigma_{y,y'}
-        tau: tau_{y',x_{i+1}}
-        totalProb: alpha_STOP(n)
+  @cython.boundscheck(False)
+  @cython.wraparound(False)
+  cdef void _prunedExpectations(self, np.ndarray[double, ndim=2] sigma, np.ndarray[double, ndim=2] taus,
+                                np.ndarray[double, ndim=2] alphas, np.ndarray[double, ndim=2] betas,
+                                np.ndarray[np.intp_t, ndim=2] survivors, np.ndarray[np.intp_t] numSurvivors,
+                                np.ndarray[np.intp_t] wordColumns, np.ndarray[double] scales,
+                                np.ndarray[double, ndim=2] expected_yx, np.ndarray[double, ndim=2] expected_yy_,
+                                np.ndarray[double] expected_ycirc):
+    cdef int i, j, k, c, d, x, n = taus.shape[0]
+    cdef double a, posterior
+
+    for i in xrange(n-1): # each word but the final STOP
+      x = wordColumns[i]
+      for j in xrange(numSurvivors[i]):
+        c = survivors[i,j]
+        posterior = alphas[i,c]*betas[i,c] # E[n_{i,y,x}|x]
+        expected_yx[c,x] += posterior
+        expected_ycirc[c] += posterior
+        a = alphas[i,c]/scales[(i+1)]
+        for k in xrange(numSurvivors[(i+1)]): # E[n_{i,y,y'}|x]
+          d = survivors[(i+1),k]
+          expected_yy_[c,d] += a*sigma[c,d]*taus[(i+1),d]*betas[(i+1),d]
+
+  """ Perform the E-Step of EM over sentences s_first..s_first+len(sentences). Accumulate
+       the expectations in place, where column k of expected_yx is the output columns[k].
+      Return: (log-likelihood of the sentences, number of sentences skipped as improbable,
+               pruned: [sum over timesteps of the fraction of forward mass pruned, num. of timesteps pruned])
   """
-  @cython.cdivision(True)
-  cdef double _expTransitionFreq(self, double alpha_y, double beta_yprime,
-                                 double sigma, double tau, double totalProb):
-    return alpha_y*sigma*tau*beta_yprime/totalProb
-
-  """ Verify model consistency in computing forward/backward probabilities. """
-  cdef int _verifyProbs(self, double[:] alpha, double[:] beta, double totalProb):
-    cdef double alpha_y, beta_y, prob
-    cdef int y
-    prob = 0.0
-    for y in range(0, self._numStates):
-      prob += self._expEmissionFreq(alpha[y], beta[y], totalProb)
-
-    if abs(1.0 - prob) > 1e-6: # probabilities should sum to 1
-      return 0
-    return 1
-
-  """ Perform the E-Step of EM. Return the expectations. """
-  cdef void _do_EStep(self, object expected_yx, double[:,:] expected_yy_, double[:] expected_ycirc,
-                       int iteration, int iter_cap):
-    # s: sentence, n_sentence: # sentences, n: len(sentence), ALPHA=0, BETA=1, j:beta index
-    cdef int s, n_sentence, n, ALPHA, BETA, i, j
-    cdef long x_i, x_i1, x_j1
-    cdef int STOPTAGIDX = self._STOPTAG
-    cdef double alpha_y, beta_y, totalProb, sigma, tau, expOutputFreq
-
-    cdef np.ndarray[double, ndim=2] alphas, betas
+  cdef tuple _do_EStep(self, list sentences, int s_first, np.ndarray columns,
+                      np.ndarray[double, ndim=2] expected_yx, np.ndarray[double, ndim=2] expected_yy_,
+                      np.ndarray[double] expected_ycirc, int iteration, int iter_cap):
+    # s: sentence, n_sentence: # sentences, n: len(sentence), ALPHA=0, BETA=1
+    cdef int s, n_sentence, n, ALPHA, BETA, skipped = 0
+    cdef double logProb, logLikelihood = 0.0
+    cdef bint pruning = self._pruneThreshold > 0.0 or self._pruneTop > 0
+
+    cdef np.ndarray[double, ndim=2] sigma = self._sigma
+    cdef np.ndarray[double, ndim=2] alphas, betas, taus, posteriors
     cdef np.ndarray[double, ndim=3] alphaBetaMat
-
-    cdef double[:,:] sigmaMat = self._sigma # memoryview on numpy array
+    cdef np.ndarray[double] scalesVec, scales
     ALPHA, BETA = 0, 1 # indices
 
-    s = 1
-    n_sentence = len(self._outputs) 
-    for sentence in self._outputs:
-      print "- sentence: %i of %i \t\t (iteration %i/%i)"%(s,n_sentence,iteration,iter_cap)
-      sys.stdout.flush()
+    # one workspace for every sentence, sized to the longest:
+    n = max(len(sentence) for sentence in sentences) if sentences else 0
+    alphaBetaMat = np.empty([2, n, self._numStates]) # [alpha or beta][timestep][state] -> prob.
+    scalesVec = np.empty(n) # [timestep] -> scale of the alphas and betas
+    pruned = np.zeros(2)
+    if pruning:
+      survivors = np.empty([n, self._numStates], dtype=np.intp) # [timestep][k] -> kth surviving state
+      numSurvivors = np.empty(n, dtype=np.intp)
+      scratch = np.empty(self._numStates)
+
+    progress = metrics.getMetrics().progress
+    s = s_first
+    n_sentence = self._n_sentences
+    for sentence in sentences:
+      progress("- sentence: %i of %i \t\t (iteration %i/%i)", s, n_sentence, iteration, iter_cap)
       s+=1
 
       n = len(sentence)
+      taus = self._tau[:,sentence].T # [timestep][state] -> tau_{y,x_i}
+      alphas = alphaBetaMat[ALPHA,:n,:]
+      betas = alphaBetaMat[BETA,:n,:]
+      scales = scalesVec[:n]
+
+      if pruning:
+        logProb, prunedMass = self._prunedForwardBackward(sigma, taus, alphas, betas,
+                                                          survivors, numSurvivors, scratch, scales)
+        pruned += (prunedMass, max(n-2, 0))
+      else:
+        logProb = self._forwardBackward(sigma, taus, alphas, betas, scales)
+      if logProb == -np.inf: # problem: nothing to learn from this sentence
+        sys.stderr.write("Sentence %i has zero probability, skipping.\n" % (s-1))
+        skipped += 1
+        continue
+      logLikelihood += logProb
+      if pruning:
+        self._prunedExpectations(sigma, taus, alphas, betas, survivors, numSurvivors,
+                                 np.searchsorted(columns, sentence), scales, expected_yx, expected_yy_, expected_ycirc)
+        continue
+
+      # E[n_{i,y,x}|x] = alpha_y(i)*beta_y(i)/totalProb, which the scaled alphas and betas
+      #  already are, for each word but the final STOP:
+      posteriors = alphas[:(n-1)]*betas[:(n-1)]
+      np.add.at(expected_yx.T, np.searchsorted(columns, sentence[:(n-1)]), posteriors)
+      expected_ycirc += posteriors.sum(axis=0)
+
+      # E[n_{i,y,y'}|x] = alpha_y(i)*sigma_{y,y'}*tau_{y',x_{i+1}}*beta_{y'}(i+1)/totalProb
+      #  (= the scaled alpha_y(i)*sigma_{y,y'}*tau_{y',x_{i+1}}*beta_{y'}(i+1)/scales[i+1]),
+      #  i.e. one outer product per timestep, summed over the sentence as a single matrix product:
+      expected_yy_ += np.dot(alphas[:(n-1)].T, taus[1:]*betas[1:]/scales[1:,np.newaxis])*sigma
+
+    return logLikelihood, skipped, pruned
+
+  """ Perform the E-Step of EM over one shard of the corpus, sentences [start,end), from zero counts.
+      Return: (columns, e_yx, e_yy_, e_ycirc, logLikelihood, skipped, pruned), where e_yx holds only the
+               columns of the outputs this shard emits, i.e. e_yx[:,k] = E[n_{y,x}|x] for x = columns[k],
+               logLikelihood is that of the shard's sentences, but the skipped improbable ones,
+               and pruned is as returned by _do_EStep()
+  """
+  def expectShard(self, int start, int end, int iteration, int iter_cap):
+    return self._expectSentences(self._corpus.getUnkedSentences(start, end), start+1, iteration, iter_cap)
 
-      alphaBetaMat = np.zeros([2, n, self._numStates]) # [alpha or beta][timestep][state] -> prob.
-      alphaBetaMat[ALPHA,0,STOPTAGIDX] = 1.0
-      alphaBetaMat[BETA,(n-1),STOPTAGIDX] = 1.0
-
-      # iterate over sentence without initial STOP for alpha, last STOP for beta
-      # e.g. [STOP, "hello", "world", STOP]
-      # Calculate alpha and beta using our sigmas and taus
-      alphas = alphaBetaMat[ALPHA,:,:]
-      betas = alphaBetaMat[BETA,:,:]
-
-      for i in xrange(1,n): # compute fwd/backward probs
-        j = n - i - 1
-        x_i = sentence[i]
-        x_j1 = sentence[j+1]
-        self._computeAlphasTimestep(sigmaMat, alphas, i, x_i) # compute alphas for this timestep
-        self._computeBetasTimestep(sigmaMat, betas, j, x_j1) # compute betas for this timestep
-
-      for i in xrange(0,n): # normalise fwd/backward probs
-        self._normaliseAlphaBeta(alphas[i], betas[i])
-        #if self._verifyProbs(alphas[i], betas[i], betas[0][STOPTAGIDX]) == 0:
-        #  sys.stderr.write("Probabilities not valid!\n")
-
-      if alphas[(n-1),STOPTAGIDX] == 0.0: # problem
-        print alphas
-        sys.exit(1)
-
-      # Here we go again, now to calculate expectations
-      for i in xrange(n-1): # for each word in the sentence
-        x_i = sentence[i]
-        x_i1 = sentence[i+1]
-        for y in range(0,self._numStates): # iterate over each label y
-          alpha_y = alphas[i,y]
-          beta_y = betas[i,y]
-          totalProb = alphas[(n-1),STOPTAGIDX]
-
-          expOutputFreq = self._expEmissionFreq(alpha_y, beta_y, totalProb)
-          expected_yx[(y,x_i)] += expOutputFreq
-          expected_ycirc[y] += expOutputFreq
-
-          for y_ in range(0,self._numStates): # iterate over y' for E[n_{y,y'}|x]
-            beta_y_ = betas[(i+1),y_]
-            sigma = sigmaMat[y,y_]
-            tau = self._tau[(y_,x_i1)]
-            expected_yy_[y,y_] += self._expTransitionFreq(alpha_y,beta_y_,sigma,tau,totalProb)
-
-  """ Perform the M-Step of EM. Update sigma and tau mappings using expectations. """ 
-  cdef void _do_MStep(self, expected_yx, double[:,:] expected_yy_, double[:] expected_ycirc):
-    cdef double[:,:] sigmaMat = self._sigma # memoryview on numpy array
-    cdef int y, yprime
-    cdef float alpha = self._alpha
-    for y in range(0,self._numStates):
-      for yprime in range(0,self._numStates):
-        # smooth sigma:
-        sigmaMat[y,yprime] = (expected_yy_[y,yprime]+alpha)/(expected_ycirc[y]+alpha*self._numStates)
-
-    for emission,expectation in expected_yx.iteritems():
-      y, _ = emission
-      # smooth tau:
-      self._tau[emission] = (expectation+alpha)/(expected_ycirc[y] + alpha*self._numStates)
-
-  cdef void _train(self, int ITER_CAP, tuple visible_params):
-    cdef int i = 1 # counts iterations of EM
-    cdef double[:,:] e_yy_ # E[n_{y,y'}|x]: (y,y')->float
-    cdef double[:] e_ycirc # E[n_{y,\circ}|x]: y->float
-
+  """ Perform the E-Step of EM over a list of encoded sentences, the first of which is
+       sentence number s_first of the corpus, from zero counts. Return as for expectShard().
+  """
+  def _expectSentences(self, list sentences, int s_first, int iteration, int iter_cap):
+    columns = np.unique(np.concatenate(sentences)) if sentences else np.zeros(0, dtype=np.int32)
+    e_yx = np.zeros([self._numStates, len(columns)])
+    e_yy_ = np.zeros([self._numStates]*2)
+    e_ycirc = np.zeros(self._numStates)
+
+    logLikelihood, skipped, pruned = self._do_EStep(sentences, s_first, columns, e_yx, e_yy_, e_ycirc,
+                                                     iteration, iter_cap)
+    return columns, e_yx, e_yy_, e_ycirc, logLikelihood, skipped, pruned
+
+  """ Perform the M-Step of EM. Update sigma and tau mappings using expectations.
+      Only the (y,x) with an expectation, i.e. x in this corpus or seen with y in visible
+       data, are re-estimated; the rest keep their smoothed values.
+  """
+  cdef void _do_MStep(self, np.ndarray[double, ndim=2] expected_yx, np.ndarray[double, ndim=2] expected_yy_,
+                      np.ndarray[double] expected_ycirc):
+    norm = expected_ycirc[:,np.newaxis] + self._alpha*self._numStates
+
+    # smooth sigma:
+    self._sigma = (expected_yy_ + self._alpha)/norm
+
+    # smooth tau:
+    update = (expected_yx > 0.0) | self._observed
+    self._tau[update] = ((expected_yx + self._alpha)/norm)[update]
+    self._tauCache.clear()
+
+  """ Extend a (labels x visible vocab) matrix to this model's vocabulary, filling new columns with fill """
+  cdef _padColumns(self, np.ndarray mat, fill):
+    padded = np.empty([self._numStates, len(self._vocab)])
+    padded[:,mat.shape[1]:] = fill
+    padded[:,:mat.shape[1]] = mat
+    return padded
+
+  """ Start from the distributions of a VisibleDataHMM whose vocabulary this model extends.
+      Smoothing of the (y,x) pairs unseen in visible data accounts for this corpus' word count.
+  """
+  cdef void _initFromVisible(self, sigma, tau, n_yx, n_ycirc):
+    self._sigma = np.copy(sigma)
+    self._tauSmooth = self._alpha/(n_ycirc + self._alpha*self._wc)
+    smooth = self._tauSmooth[:,np.newaxis]
+    self._tau = self._padColumns(np.where(n_yx > 0, tau, smooth), smooth)
+    self._tauCache.clear()
+
+  """ Return the expectations every iteration of EM starts from: zero counts, or the weighted
+       counts of visible data, in which case the distributions start from the visible ones.
+  """
+  cdef tuple _startExpectations(self, tuple visible_params):
     # this weight factor affects how much the counts derived from labeled training data
     #  should be weighted, as a function of the size of the unlabeled training data:
-    cdef double weightFactor = self._WEIGHTCOEF*np.log(len(self._outputs)+np.e**(1/self._WEIGHTCOEF))
+    cdef double weightFactor = self._WEIGHTCOEF*np.log(self._n_sentences+np.e**(1/self._WEIGHTCOEF))
 
-    print "Beginning train iterations (EM)..."
-    start_expectations = defaultdict(float), np.zeros([self._numStates]*2), np.zeros(self._numStates)
+    start_expectations = (np.zeros([self._numStates, len(self._vocab)]), np.zeros([self._numStates]*2),
+                          np.zeros(self._numStates))
     if visible_params:
       start_distribution, start_expectations = visible_params
-      self._sigma, self._tau = start_distribution
+      sigma, tau = start_distribution
       exp_yx, exp_yy_, exp_ycirc = start_expectations # temporarily unpack these to weight them
+      self._initFromVisible(sigma, tau, exp_yx, exp_ycirc)
 
       # weight these expectation counts because they are more correct:
       exp_yy_ = exp_yy_*weightFactor
       exp_ycirc = exp_ycirc*weightFactor
-      for key,val in exp_yx.iteritems():
-        exp_yx[key] = val*weightFactor
-
-      self._tau._wc = self._wc # update taudict's internal wordcount
-      self._alpha = self._tau._alpha
+      exp_yx = self._padColumns(exp_yx*weightFactor, 0.0)
+      start_expectations = exp_yx, exp_yy_, exp_ycirc
 
-    while i <= ITER_CAP:
-      print "iteration %i" % i
+    return start_expectations
 
-      e_yx, e_yy_, e_ycirc = start_expectations
-
-      # (E-step):
-      self._do_EStep(e_yx, e_yy_, e_ycirc, i, ITER_CAP)
-
-      # (M-step): update sigma and tau
-      self._do_MStep(e_yx, e_yy_, e_ycirc)
+  """ Start from the distributions of another model, e.g. trained on part of this corpus. The columns
+       of tau are matched by output, so that outputs new to this model keep their initial values.
+  """
+  cdef void _initFromModel(self, model):
+    sigma, tau = model.getDistribution()
+    vocab = model.getVocabulary()
+    columns = np.array([vocab.getId(x) for x in self._vocab], dtype=object)
+    found = np.flatnonzero(columns != None)
+
+    self._sigma = np.copy(sigma)
+    self._tau[:,found] = tau[:,columns[found].astype(np.intp)]
+    self._tauCache.clear()
+
+  """ Continue from a checkpoint saved by _train(). Return: the iteration it was saved after """
+  cdef int _resumeFrom(self, dict state) except -1:
+    missing = [name for name in ("iteration", "sigma", "tau", "converged", "logLikelihoods") if name not in state]
+    if missing:
+      raise ValueError("The checkpoint is incomplete, with no %s" % ", ".join(missing))
+    if state["sigma"].shape != self._sigma.shape or state["tau"].shape != self._tau.shape:
+      raise ValueError("The checkpoint's tags or vocabulary are not this model's")
+    self._sigma = np.array(state["sigma"])
+    self._tau = np.array(state["tau"])
+    self._tauCache.clear()
+    return int(state["iteration"])
+
+  cdef void _train(self, int ITER_CAP, tuple visible_params, int jobs, pool, tuple shared, warmStart,
+                   double minImprovement, checkpoint, int checkpointEvery, bint resume) except *:
+    cdef int i = 1 # counts iterations of EM
+    cdef bint converged = False
+    cdef double improvement
+    cdef np.ndarray[double, ndim=2] e_yx # E[n_{y,x}|x]: [y,x]->float
+    cdef np.ndarray[double, ndim=2] e_yy_ # E[n_{y,y'}|x]: [y,y']->float
+    cdef np.ndarray[double] e_ycirc # E[n_{y,\circ}|x]: y->float
+
+    telemetry = metrics.getMetrics()
+    telemetry.say("Beginning train iterations (EM)...")
+    start_expectations = self._startExpectations(visible_params)
+    if warmStart is not None:
+      self._initFromModel(warmStart)
+
+    logLikelihoods = [] # of every iteration's E-step
+    state = persist.loadCheckpoint(checkpoint) if resume else None
+    if state is not None:
+      i = self._resumeFrom(state) + 1
+      logLikelihoods = list(state["logLikelihoods"])
+      converged = bool(state["converged"])
+      telemetry.say("Resuming from the checkpoint after iteration %i in %s", i-1, checkpoint)
+    elif resume:
+      telemetry.say("No checkpoint in %s, starting from the first iteration", checkpoint)
+
+    n_sentence = self._n_sentences
+    shards = [(start, min(start+DFLT_SHARD_SIZE, n_sentence)) for start in xrange(0, n_sentence, DFLT_SHARD_SIZE)]
+
+    while i <= ITER_CAP and not converged:
+      telemetry.say("iteration %i", i)
+      telemetry.resetProgress()
+
+      # every iteration starts over from the (visible) starting counts:
+      e_yx, e_yy_, e_ycirc = [np.copy(e) for e in start_expectations]
+
+      # (E-step): map over shards of the corpus, reducing their counts in shard order
+      with telemetry.phase("estep", iteration=i, jobs=jobs) as phase:
+        if pool is not None:
+          shared[0][...] = self._sigma # what the workers' E-steps read
+          shared[1][...] = self._tau
+          partials = pool.imap(_shardEStep, [shard+(i, ITER_CAP) for shard in shards])
+        else:
+          partials = (self.expectShard(start, end, i, ITER_CAP) for start,end in shards)
+
+        logLikelihood, skipped, pruned = 0.0, 0, np.zeros(2)
+        for columns, p_yx, p_yy_, p_ycirc, p_logLikelihood, p_skipped, p_pruned in partials:
+          e_yx[:,columns] += p_yx
+          e_yy_ += p_yy_
+          e_ycirc += p_ycirc
+          logLikelihood += p_logLikelihood
+          skipped += p_skipped
+          pruned += p_pruned
+
+        phase.count(n_sentence, self._corpus.numTokens())
+        phase.set(log_likelihood=logLikelihood, skipped=skipped)
+        self._reportPruned(phase, pruned)
+      telemetry.say("- log-likelihood: %f", logLikelihood)
+
+      # stop once the log-likelihood improves by less than minImprovement (relative):
+      if logLikelihoods and minImprovement > 0.0:
+        improvement = (logLikelihood - logLikelihoods[-1])/abs(logLikelihoods[-1])
+        converged = improvement < minImprovement
+        if converged:
+          telemetry.say("Converged: the log-likelihood improved by %g, less than %g", improvement, minImprovement)
+          telemetry.record("converged", iteration=i, improvement=improvement)
+      logLikelihoods.append(logLikelihood)
+
+      # (M-step): update sigma and tau, from this last E-step too
+      with telemetry.phase("mstep", iteration=i):
+        self._do_MStep(e_yx, e_yy_, e_ycirc)
+
+      if checkpoint is not None and (i % checkpointEvery == 0 or i == ITER_CAP or converged):
+        with telemetry.phase("checkpoint", iteration=i):
+          persist.saveCheckpoint({"iteration": i, "sigma": self._sigma, "tau": self._tau, "expected_yx": e_yx,
+                                  "expected_yy_": e_yy_, "expected_ycirc": e_ycirc, "converged": converged,
+                                  "logLikelihoods": np.array(logLikelihoods)}, checkpoint)
 
       i += 1 # increment iterations count
 
+  """ Yield the corpus as lists of at most batchSize encoded sentences, streaming it from
+       the unker if it isn't kept in memory.
+  """
+  def _iterBatches(self, int batchSize):
+    if self._corpus is not None:
+      for start in xrange(0, self._n_sentences, batchSize):
+        yield self._corpus.getUnkedSentences(start, min(start+batchSize, self._n_sentences))
+      return
+
+    if self._unkMap is not None:
+      sentences = (self._unkMap[ids] for ids in self._unker.getOrigCorpus().iterIds())
+    else:
+      sentences = (self._vocab.encode(sentence) for sentence in self._unker.getUnkedCorpus())
+    batch = []
+    for sentence in sentences:
+      batch.append(sentence)
+      if len(batch) == batchSize:
+        yield batch
+        batch = []
+    if batch:
+      yield batch
+
+  cdef void _trainOnline(self, int ITER_CAP, tuple visible_params, int batchSize, double stepExponent) except *:
+    cdef int k = 0, epoch = 1, s # k counts updates, s counts sentences of an epoch
+    cdef double eta, scale
+    cdef np.ndarray[double, ndim=2] mu_yx, mu_yy_ # running averages of the expectations
+    cdef np.ndarray[double] mu_ycirc
+
+    telemetry = metrics.getMetrics()
+    telemetry.say("Beginning train iterations (online EM)...")
+    start_yx, start_yy_, start_ycirc = self._startExpectations(visible_params)
+    mu_yx, mu_yy_, mu_ycirc = np.zeros_like(start_yx), np.zeros_like(start_yy_), np.zeros_like(start_ycirc)
+
+    while epoch <= ITER_CAP:
+      telemetry.say("epoch %i", epoch)
+      telemetry.resetProgress()
+      s = 0
+      for batch in self._iterBatches(batchSize):
+        # (E-step) on the minibatch only:
+        with telemetry.phase("estep", iteration=epoch, batch=k) as phase:
+          columns, p_yx, p_yy_, p_ycirc, logLikelihood, skipped, pruned = self._expectSentences(batch, s+1, epoch,
+                                                                                                ITER_CAP)
+          phase.count(len(batch), sum(len(sentence) for sentence in batch))
+          phase.set(log_likelihood=logLikelihood, skipped=skipped)
+          self._reportPruned(phase, pruned)
+        self._observed[columns] = True
+        s += len(batch)
+
+        # interpolate towards the minibatch's expectations, scaled up to the size of the corpus
+        #  so that they stay comparable with the (weighted) visible counts:
+        eta = (k+1)**(-stepExponent)
+        scale = eta*self._n_sentences/len(batch)
+        mu_yx *= 1.0-eta
+        mu_yx[:,columns] += scale*p_yx
+        mu_yy_ = (1.0-eta)*mu_yy_ + scale*p_yy_
+        mu_ycirc = (1.0-eta)*mu_ycirc + scale*p_ycirc
+
+        # (M-step): update sigma and tau after every minibatch
+        with telemetry.phase("mstep", iteration=epoch, batch=k):
+          self._do_MStep(start_yx + mu_yx, start_yy_ + mu_yy_, start_ycirc + mu_ycirc)
+        k += 1
+
+      epoch += 1
+
+  """ Record on an E-step's phase the mean fraction of forward mass pruned per timestep, if pruning """
+  def _reportPruned(self, phase, pruned):
+    mass, steps = pruned
+    if steps > 0:
+      phase.set(pruned_mass=mass/steps)
+      metrics.getMetrics().say("- pruned %.4f%% of the forward mass", 100*mass/steps)
+
+  """ Prune the forward-backward of the E-step to, at each timestep, the states whose forward
+       probability is at least threshold times the timestep's best (if threshold > 0), and of
+       those only the top best (if top > 0). The expectations are then accumulated over the
+       surviving states only: much faster for large tagsets, at the cost of the pruned mass,
+       which E-steps report. With neither, the E-step is exact.
+  """
+  def setPruning(self, threshold=0.0, top=0):
+    if threshold < 0.0 or threshold >= 1.0 or top < 0:
+      raise ValueError("Pruning needs 0 <= threshold < 1 and top >= 0")
+    self._pruneThreshold = threshold
+    self._pruneTop = top
+
   """ Train the HMM using EM to estimate sigma and tau distributions.
         params: (visible_distribution, visible_counts) where
                 visible_distribution=(sigma,tau) of the VisibleDataHMM
                 visible_counts=(n_yy_, n_ycirc) of the VisibleDataHMM
 
                 pass None if these are not available (for purely unsupervised)
+        jobs: number of worker processes to run the E-step on (default is 1)
+        warmStart: (optional) a trained HiddenDataHMM with the same labels to start EM from,
+                   rather than from the visible (or random) distributions
+        minImprovement: (optional) stop before the iteration cap once an iteration improves the
+                        log-likelihood of the corpus by less than this, relative to the last
+        checkpoint: (optional) path of a directory to save the state of EM to: sigma, tau, the
+                    expected counts and the log-likelihoods, after every checkpointEvery
+                    iterations and the last
+        resume: if True, continue from the checkpoint, if there is one, rather than from the first
+                iteration. The model must have been set up as it was for the checkpointed run.
   """
-  def train(self, params):
+  def train(self, params, jobs=1, warmStart=None, minImprovement=0.0, checkpoint=None,
+            checkpointEvery=DFLT_CHECKPOINT_EVERY, resume=False):
     iter_cap, visible_params = params
-    self._train(iter_cap, visible_params)
-    print "Done."
+    if self._corpus is None:
+      raise ValueError("A streamed HiddenDataHMM can only be trained with trainOnline()")
+    if resume and checkpoint is None:
+      raise ValueError("Resuming needs the path of a checkpoint")
+
+    pool, shared = None, None
+    if jobs > 1: # fork the E-step workers once, for every iteration
+      shared = (_sharedArray(self._sigma.shape), _sharedArray(self._tau.shape))
+      pool = multiprocessing.Pool(jobs, _initEStepWorker, (self,) + shared)
+    try:
+      self._train(iter_cap, visible_params, jobs, pool, shared, warmStart, minImprovement, checkpoint,
+                  checkpointEvery, resume)
+    except: # e.g. a worker's error, or Ctrl-C: don't leave the workers behind
+      if pool is not None:
+        pool.terminate()
+      raise
+    if pool is not None:
+      pool.close()
+      pool.join()
+    metrics.getMetrics().say("Done.")
+
+  """ Train the HMM using online (stepwise) EM, which re-estimates sigma and tau after each
+       minibatch of the corpus rather than after a full pass, so that large corpora converge
+       in few passes, and needn't be held in memory (see stream in the constructor).
+        params: as for train(), with the number of passes over the corpus in place of iterations
+        batchSize: number of sentences per minibatch
+        stepExponent: the k-th minibatch's expectations are weighted by eta_k = (k+1)^-stepExponent, in (0.5, 1]
+  """
+  def trainOnline(self, params, batchSize=DFLT_ONLINE_BATCH, stepExponent=DFLT_STEP_EXPONENT):
+    iter_cap, visible_params = params
+    if batchSize < 1 or not 0.5 < stepExponent <= 1.0:
+      raise ValueError("Online EM needs batchSize >= 1 and 0.5 < stepExponent <= 1")
+    self._trainOnline(iter_cap, visible_params, batchSize, stepExponent)
+    metrics.getMetrics().say("Done.")
 
   """ Return sigma_{y,yprime} - transition prob. from state y->yprime """
   def getSigma(self, y, yprime):
@@ -264,9 +714,25 @@ cdef class HiddenDataHMM:
 
   """ Compute tau_{y,x} - emission prob. of state y->output x """
   def getTau(self, y, x):
-    y = self._labelHash[y]
-    x = hash(self._unker.evaluateWord(x)) # check if x should be unked and hash
-    return self._tau[(y,x)]
+    return self.getTauVector(x)[self._labelHash[y]]
+
+  """ Return tau_{y,x} for every label y of the tau column x """
+  def _tauOfColumn(self, x):
+    return np.ascontiguousarray(self._tau[:,x])
+
+  """ Return tau_{y,x} for every label y of a given x, as a vector indexed by int label,
+       cached by the UNKed form of x
+  """
+  def getTauVector(self, x):
+    return common.cachedTauVector(x, self._unker, self._vocab, self._tauCache, self._tauSmooth, self._tauOfColumn)
+
+  """ Return the (hits, misses) of the cache of getTauVector() """
+  def getTauCacheStats(self):
+    return self._tauCache.getStats()
+
+  """ Return tau_{y,x} for every label y of an x not in the vocabulary """
+  def getTauSmoothing(self):
+    return self._tauSmooth
 
   """ Return a copy of the model's labels """
   def getLabels(self):
@@ -276,9 +742,17 @@ cdef class HiddenDataHMM:
   def getLabelHash(self):
     return dict(self._labelHash)
 
+  """ Return the vocabulary mapping each output x to its column in the tau matrix """
+  def getVocabulary(self):
+    return self._vocab
+
+  """ Return the unker used to evaluate outputs """
+  def getUnker(self):
+    return self._unker
+
   """ Return a copy of the trained internal distributions sigma and tau """
   def getDistribution(self):
-    return (np.copy(self._sigma), dict(self._tau))
+    return (np.copy(self._sigma), np.copy(self._tau))
 
   """ Return the number of unique words in this HMM's corpus """
   def getWordCount(self):
@@ -0,0 +1,134 @@
+# Telemetry of training and tagging: timed phases, throughput, and rate-limited progress
+import json
+import sys
+import time
+
+DFLT_PROGRESS_INTERVAL = 5.0 # min. seconds between progress messages
+
+""" Records where the time of a run goes, as JSON lines written to a file (if any), e.g.
+      {"event": "phase", "phase": "estep", "iteration": 1, "seconds": 2.5, "sentences": 1000, ...}
+     and reports progress on stdout, at most every progressInterval seconds rather than per sentence
+     (or not at all, if quiet).
+    Models record to the current Metrics (see getMetrics() and setMetrics()), so that
+     it needn't be passed through every call.
+"""
+class Metrics:
+
+  """ out: (optional) an open file to write JSON lines to
+      progressInterval: min. seconds between progress messages
+      quiet: whether to drop the progress messages, e.g. when the output is a table of results
+  """
+  def __init__(self, out=None, progressInterval=DFLT_PROGRESS_INTERVAL, quiet=False):
+    self._out = out
+    self._interval = progressInterval
+    self._quiet = quiet
+    self._start = time.time()
+    self._lastProgress = None # time of the last progress message
+    self._profiler = None
+
+  """ Profile phases with profiler (e.g. a profiling.PhaseProfiler), which is started and
+       stopped around each phase, by name
+  """
+  def setProfiler(self, profiler):
+    self._profiler = profiler
+
+  """ Write an event, with any fields, and the seconds since the run began """
+  def record(self, event, **fields):
+    if self._out is None:
+      return
+    fields["event"] = event
+    fields["time"] = round(time.time() - self._start, 6)
+    self._out.write(json.dumps(fields, sort_keys=True) + "\n")
+    self._out.flush()
+
+  """ Return a context in which to time a phase, e.g.
+        with metrics.phase("decode") as phase:
+          ...
+          phase.count(sentences, tokens)
+      which records the seconds spent, and the throughput of what was counted.
+  """
+  def phase(self, name, **fields):
+    return Phase(self, name, fields)
+
+  """ Print message % args on stdout, unless a message was printed within the last interval.
+      Formatting is deferred until printing, so this is cheap enough to call per sentence.
+  """
+  def progress(self, message, *args):
+    if self._quiet:
+      return
+    now = time.time()
+    if self._lastProgress is not None and now - self._lastProgress < self._interval:
+      return
+    self._lastProgress = now
+    print message % args
+    sys.stdout.flush()
+
+  """ Print message % args on stdout, unless quiet: for messages that are never rate-limited,
+       such as the start of each iteration
+  """
+  def say(self, message, *args):
+    if self._quiet:
+      return
+    print message % args
+    sys.stdout.flush()
+
+  """ Allow the next progress message through, e.g. at the start of a new iteration """
+  def resetProgress(self):
+    self._lastProgress = None
+
+  def close(self):
+    if self._out is not None:
+      self._out.close()
+      self._out = None
+
+""" A timed phase of a run, see Metrics.phase() """
+class Phase:
+
+  def __init__(self, metrics, name, fields):
+    self._metrics = metrics
+    self._name = name
+    self._fields = fields
+    self._sentences = self._tokens = 0
+
+  """ Count sentences and tokens processed in this phase, for its throughput """
+  def count(self, sentences=0, tokens=0):
+    self._sentences += sentences
+    self._tokens += tokens
+
+  """ Add fields to the record of this phase, e.g. its log-likelihood """
+  def set(self, **fields):
+    self._fields.update(fields)
+
+  def __enter__(self):
+    profiler = self._metrics._profiler
+    self._profiled = profiler is not None and profiler.start(self._name)
+    self._begin = time.time()
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    if self._profiled:
+      self._metrics._profiler.stop(self._name)
+    if excType is not None: # the phase didn't finish, so there's nothing to measure
+      return False
+
+    seconds = time.time() - self._begin
+    fields = dict(self._fields, phase=self._name, seconds=round(seconds, 6))
+    for unit,n in (("sentences", self._sentences), ("tokens", self._tokens)):
+      if n: # only what was counted
+        fields[unit] = n
+        if seconds > 0:
+          fields[unit + "_per_second"] = round(n/seconds, 3)
+    self._metrics.record("phase", **fields)
+    return False
+
+# The Metrics that models record to: only progress messages, until setMetrics() is called
+_metrics = Metrics()
+
+def getMetrics():
+  return _metrics
+
+""" Make metrics the current Metrics, and return the previous one """
+def setMetrics(metrics):
+  global _metrics
+  previous, _metrics = _metrics, metrics
+  return previous
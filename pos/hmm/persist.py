@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import numpy as np
+
+from . import _common as common
+from . import unk
+
+FORMAT_VERSION = 2 # bump this whenever the layout of a saved model changes
+CHECKPOINT_VERSION = 1 # likewise for checkpoints of EM
+
+""" Pack a list of strings into one byte buffer and the offsets of each string in it
+     (string i is blob[offsets[i]:offsets[i+1]])
+"""
+def _packStrings(strings):
+  offsets = np.zeros(len(strings)+1, dtype=np.int64)
+  offsets[1:] = np.cumsum([len(s) for s in strings])
+  blob = np.frombuffer("".join(strings), dtype=np.uint8)
+  return blob, offsets
+
+""" Inverse of _packStrings: return the list of strings """
+def _unpackStrings(blob, offsets):
+  data = blob.tobytes()
+  return [data[offsets[i]:offsets[i+1]] for i in xrange(len(offsets)-1)]
+
+""" Pack a list of strings as with _packStrings, along with the ids of the strings
+     in sorted order so that MappedStrings can binary search them.
+"""
+def _packSortedStrings(strings):
+  blob, offsets = _packStrings(strings)
+  order = np.array(sorted(xrange(len(strings)), key=strings.__getitem__), dtype=np.int64)
+  return blob, offsets, order
+
+""" A read-only table of strings, e.g. a vocabulary, kept as packed (possibly memory-mapped)
+     arrays rather than a dict, so that processes loading it share one copy of it.
+    Provides the lookup interface of a Vocabulary, with O(log n) lookups.
+"""
+class MappedStrings:
+
+  """ blob, offsets, order: as returned by _packSortedStrings """
+  def __init__(self, blob, offsets, order):
+    self._blob = blob
+    self._offsets = offsets
+    self._order = order
+
+  """ Return the id of a word, or None if the word is not in the table """
+  def getId(self, word):
+    lo, hi = 0, len(self._order)
+    while lo < hi: # binary search over the sorted ids
+      mid = (lo+hi)//2
+      i = self._order[mid]
+      if self.getWord(i) < word:
+        lo = mid+1
+      else:
+        hi = mid
+
+    if lo < len(self._order) and self.getWord(self._order[lo]) == word:
+      return int(self._order[lo])
+    return None
+
+  """ Return the word with the given id """
+  def getWord(self, i):
+    return self._blob[self._offsets[i]:self._offsets[i+1]].tobytes()
+
+  """ Return the ids of a sentence (as a list of words); unlike a Vocabulary, the table can't grow """
+  def encode(self, sentence):
+    return np.array([self.getId(word) for word in sentence], dtype=np.int32)
+
+  def __len__(self):
+    return len(self._order)
+
+  def __contains__(self, word):
+    return self.getId(word) is not None
+
+  def __iter__(self):
+    return (self.getWord(i) for i in xrange(len(self)))
+
+""" Word counts of an unker, backed by a MappedStrings table of the words """
+class MappedCounts:
+
+  """ words: a MappedStrings, counts: word id -> count """
+  def __init__(self, words, counts):
+    self._words = words
+    self._counts = counts
+
+  def __getitem__(self, word):
+    i = self._words.getId(word)
+    if i is None:
+      raise KeyError(word)
+    return int(self._counts[i])
+
+  def __contains__(self, word):
+    return word in self._words
+
+  def __len__(self):
+    return len(self._words)
+
+  def __iter__(self):
+    return iter(self._words)
+
+  def keys(self):
+    return list(self._words)
+
+""" Save a trained VisibleDataHMM or HiddenDataHMM to the directory path, with everything
+     needed to decode with it: labels, sigma, tau, vocabulary and the unker's configuration.
+    Each array is written as its own .npy file, so that it can be memory-mapped by loadModel().
+"""
+def saveModel(model, path):
+  labelHash = model.getLabelHash()
+  labels = sorted(labelHash, key=labelHash.get) # in int index order
+  sigma, tau = model.getDistribution()
+  unker = model.getUnker()
+  counts = unker.getCounts()
+  unkWords = list(counts.keys())
+
+  arrays = {"version": np.array(FORMAT_VERSION), "sigma": sigma, "tau": tau,
+            "tauSmooth": model.getTauSmoothing(), "wordCount": np.array(model.getWordCount()),
+            "unkThresh": np.array(unker.getThreshold()),
+            "unkCounts": np.array([counts[w] for w in unkWords], dtype=np.int64)}
+  arrays["labels"], arrays["labelOffsets"] = _packStrings(labels)
+  arrays["unker"], arrays["unkerOffsets"] = _packStrings([unker.__class__.__name__])
+  arrays["vocab"], arrays["vocabOffsets"], arrays["vocabOrder"] = _packSortedStrings(list(model.getVocabulary()))
+  arrays["unkWords"], arrays["unkWordOffsets"], arrays["unkWordOrder"] = _packSortedStrings(unkWords)
+
+  if not os.path.isdir(path):
+    os.makedirs(path)
+  for name,arr in arrays.iteritems():
+    np.save(os.path.join(path, name + ".npy"), arr)
+
+""" Load a model saved by saveModel() from the directory path. Return a TrainedHMM
+    If mmap (default), the large arrays are memory-mapped read-only instead of read into memory,
+     so that any number of processes decoding with the model share one page-cached copy of it.
+"""
+def loadModel(path, mmap=True):
+  mode = "r" if mmap else None
+  load = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mode)
+
+  if not os.path.isfile(os.path.join(path, "version.npy")):
+    raise ValueError("%s is not a saved model" % path)
+  version = int(load("version"))
+  if version != FORMAT_VERSION:
+    raise ValueError("%s: unsupported saved model version %i" % (path, version))
+
+  labels = _unpackStrings(load("labels"), load("labelOffsets"))
+  vocab = MappedStrings(load("vocab"), load("vocabOffsets"), load("vocabOrder"))
+  unkWords = MappedStrings(load("unkWords"), load("unkWordOffsets"), load("unkWordOrder"))
+
+  # an unker over an empty corpus is all that's needed to evaluate new words:
+  UnkerClass = getattr(unk, _unpackStrings(load("unker"), load("unkerOffsets"))[0])
+  unker = UnkerClass([], MappedCounts(unkWords, load("unkCounts")), int(load("unkThresh")))
+
+  return TrainedHMM(common.makeLabelHash(labels), load("sigma"), load("tau"), load("tauSmooth"),
+                    vocab, unker, int(load("wordCount")))
+
+""" A Hidden Markov Model whose distributions were already trained, e.g. loaded from disk.
+    Provides the same interface as VisibleDataHMM and HiddenDataHMM, other than training.
+"""
+class TrainedHMM:
+
+  """ Construct the HMM from:
+        labelHash: maps a string label to an internal int index
+        sigma: [y,y'] -> transition proba
+        tau: [y,x] -> emission proba, for x a column of vocab
+        tauSmooth: y -> emission proba of any x not in vocab
+        vocab: a Vocabulary (or MappedStrings) mapping outputs to tau columns
+        unker: a subclass inheriting from AbstractUnker
+        wordCount: count of unique words in the training corpus
+  """
+  def __init__(self, labelHash, sigma, tau, tauSmooth, vocab, unker, wordCount):
+    self._labelHash = labelHash
+    self._sigma = sigma
+    self._tau = tau
+    self._tauSmooth = tauSmooth
+    self._vocab = vocab
+    self._unker = unker
+    self._wc = wordCount
+    self._tauCache = common.LRUCache() # UNKed x -> tau_{.,x}
+
+  """ Return sigma_{y,yprime} - transition prob. from state y->yprime """
+  def getSigma(self, y, yprime):
+    return self._sigma[self._labelHash[y],self._labelHash[yprime]]
+
+  """ Compute tau_{y,x} - emission prob. of state y->output x """
+  def getTau(self, y, x):
+    return self.getTauVector(x)[self._labelHash[y]]
+
+  """ Return tau_{y,x} for every label y of the tau column x """
+  def _tauOfColumn(self, x):
+    return np.ascontiguousarray(self._tau[:,x])
+
+  """ Return tau_{y,x} for every label y of a given x, as a vector indexed by int label,
+       cached by the UNKed form of x
+  """
+  def getTauVector(self, x):
+    return common.cachedTauVector(x, self._unker, self._vocab, self._tauCache, self._tauSmooth, self._tauOfColumn)
+
+  """ Return the (hits, misses) of the cache of getTauVector() """
+  def getTauCacheStats(self):
+    return self._tauCache.getStats()
+
+  """ Return tau_{y,x} for every label y of an x not in the vocabulary """
+  def getTauSmoothing(self):
+    return self._tauSmooth
+
+  """ Return a copy of the model's labels """
+  def getLabels(self):
+    return set(self._labelHash.keys())
+
+  """ Return a copy of the internal mapping of str y -> int i """
+  def getLabelHash(self):
+    return dict(self._labelHash)
+
+  """ Return the vocabulary mapping each output x to its column in the tau matrix """
+  def getVocabulary(self):
+    return self._vocab
+
+  """ Return the unker used to evaluate outputs """
+  def getUnker(self):
+    return self._unker
+
+  """ Return the trained internal distributions sigma and tau """
+  def getDistribution(self):
+    return (self._sigma, self._tau)
+
+  """ Return the number of unique words in this HMM's corpus """
+  def getWordCount(self):
+    return self._wc
+
+""" Save a checkpoint of training, a dict of name -> array (or number), to the directory path,
+     one .npy file per array. The directory is replaced only once the new checkpoint is fully
+     written, so that a run killed while saving one still leaves the previous checkpoint.
+"""
+def saveCheckpoint(state, path):
+  path = path.rstrip(os.sep)
+  tmp, old = path + ".tmp", path + ".old"
+  if os.path.isdir(tmp): # left by a run killed while saving
+    shutil.rmtree(tmp)
+  os.makedirs(tmp)
+  for name,arr in state.iteritems():
+    np.save(os.path.join(tmp, name + ".npy"), np.asarray(arr))
+  np.save(os.path.join(tmp, "version.npy"), np.array(CHECKPOINT_VERSION)) # last: marks it complete
+
+  if os.path.isdir(path):
+    os.rename(path, old)
+  os.rename(tmp, path)
+  if os.path.isdir(old):
+    shutil.rmtree(old)
+
+""" Load the checkpoint saved by saveCheckpoint() to the directory path.
+    Return: the dict of name -> array, or None if there is no checkpoint
+"""
+def loadCheckpoint(path):
+  path = path.rstrip(os.sep)
+  if not os.path.isdir(path) and os.path.isdir(path + ".old"): # killed while replacing it
+    path = path + ".old"
+  if not os.path.isfile(os.path.join(path, "version.npy")):
+    return None
+  version = int(np.load(os.path.join(path, "version.npy")))
+  if version != CHECKPOINT_VERSION:
+    raise ValueError("%s: unsupported checkpoint version %i" % (path, version))
+
+  names = [fname[:-len(".npy")] for fname in os.listdir(path) if fname.endswith(".npy") and fname != "version.npy"]
+  return dict((name, np.load(os.path.join(path, name + ".npy"))) for name in names)
@@ -23,35 +23,97 @@ class UnkRule:
   def execute(self):
     return self._res
 
-""" Essentially a linked list for UnkRules """
-class UnkRuleset:
 
-  """ rule: an UnkRule
-      nextRule: an UnkRuleset or None
-  """
-  def __init__(self, rule, nextRule):
-    self._head = rule
-    self._tail = nextRule
-  
-  def getRule(self):
-    return self._head
-
-  def nextRule(self):
-    return self._tail
-  
-""" Convert a list of tuples into a linked-list UnkRuleset
-    Each tuple should be in the form (condition, result). This
-    should allow for fewer imports required by an importing module
+DFLT_CACHE_SIZE = 1 << 16 # max number of words a RuleClassifier remembers the result for
+
+""" A condition that a word ends with any of the given suffixes. Unlike an arbitrary function,
+     consecutive EndsWith rules can be compiled into one SuffixTrie by a RuleClassifier.
+"""
+class EndsWith:
+
+  def __init__(self, *suffixes):
+    self.suffixes = suffixes
+
+  def __call__(self, word):
+    for suffix in self.suffixes:
+      if word.endswith(suffix):
+        return True
+    return False
+
+""" A trie of reversed suffixes, so that every suffix rule that applies to a word is found in
+     a single walk back from the end of the word, rather than by testing the rules one by one.
+"""
+class SuffixTrie:
+
+  def __init__(self):
+    self._root = {} # char -> child node, and None -> (rank, result) if a suffix ends here
+
+  """ Add a suffix, with the rank (position) of its rule and the rule's result """
+  def add(self, suffix, rank, result):
+    node = self._root
+    for char in reversed(suffix):
+      node = node.setdefault(char, {})
+
+    if None not in node or node[None][0] > rank: # an earlier rule has precedence
+      node[None] = (rank, result)
+
+  """ Return the (rank, result) of the first-ranked rule with a suffix of word, or None """
+  def lookup(self, word):
+    node, best = self._root, self._root.get(None) # (the empty suffix)
+    for char in reversed(word):
+      node = node.get(char)
+      if node is None:
+        break
+      match = node.get(None)
+      if match is not None and (best is None or match < best):
+        best = match
+
+    return best
+
+""" Compiles a list of (condition, result) rules into a classifier of words: the result of the
+     first rule (in the order given) whose condition applies to a word, or default.
+    Consecutive EndsWith rules are compiled into a SuffixTrie, and results are memoised for
+     up to cacheSize words.
 """
-def listToRuleset(rules):
-  nextRule = None
-  ruleset = None
-  for ruleTuple in reversed(rules):
-    cond,res = ruleTuple # deconstruct the tuple
+class RuleClassifier:
+
+  def __init__(self, rules, default, cacheSize=DFLT_CACHE_SIZE):
+    self._default = default
+    self._cacheSize = cacheSize
+    self._cache = {} # word -> result
+
+    self._stages = [] # SuffixTries and UnkRules, to evaluate in order
+    for rank,(cond,res) in enumerate(rules):
+      if isinstance(cond, EndsWith):
+        if not self._stages or not isinstance(self._stages[-1], SuffixTrie):
+          self._stages.append(SuffixTrie())
+        for suffix in cond.suffixes:
+          self._stages[-1].add(suffix, rank, res)
+      else:
+        self._stages.append(UnkRule(cond, res))
+
+  """ Forget every memoised result """
+  def clearCache(self):
+    self._cache.clear()
 
-    rule = UnkRule(cond,res) # construct an UnkRule
-    ruleset = UnkRuleset(rule, nextRule)
-    nextRule = ruleset
+  """ Return the result of the first rule that applies to word """
+  def classify(self, word):
+    result = self._cache.get(word)
+    if result is not None:
+      return result
 
-  return ruleset
+    result = self._default
+    for stage in self._stages:
+      if isinstance(stage, SuffixTrie):
+        match = stage.lookup(word)
+        if match is not None:
+          result = match[1]
+          break
+      elif stage.appliesTo(word):
+        result = stage.execute()
+        break
 
+    if len(self._cache) >= self._cacheSize: # bounded: start over rather than grow
+      self._cache.clear()
+    self._cache[word] = result
+    return result
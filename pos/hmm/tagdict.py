@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from . import _common as common
+
+FALLBACKS = ["category", "open", "all"] # see TagDictionary
+DFLT_FALLBACK = "category"
+
+""" A tag dictionary: the labels each word was ever seen with in labeled data, as candidates
+     for decoding that word, since a word seen in training almost only ever takes one of its few tags.
+    Words not seen in training fall back, depending on fallback, to:
+      "category": the labels seen with the word's UNK category (i.e. with the rare words that
+                  the unker put in that category), or else as for "open"
+      "open": the labels seen with any UNK category, i.e. the open classes of rare words
+      "all": every label
+"""
+class TagDictionary:
+
+  """ labelHash: the mapping of str label -> int id the candidates are given in
+      vocab: a Vocabulary of the words (and UNK categories) of the dictionary
+      indptr, indices: the candidates of word id x are indices[indptr[x]:indptr[x+1]]
+      unker: the unker whose categories the vocab has, see AbstractUnker.unkCategory()
+      categories: int ids of the UNK categories in vocab
+      fallback: one of FALLBACKS
+  """
+  def __init__(self, labelHash, vocab, indptr, indices, unker, categories, fallback=DFLT_FALLBACK):
+    if fallback not in FALLBACKS:
+      raise ValueError("Unknown tag dictionary fallback: %s" % fallback)
+    self._labelHash = labelHash
+    self._vocab = vocab
+    self._indptr = indptr
+    self._indices = indices
+    self._unker = unker
+    self._fallback = fallback
+    self._all = np.arange(len(labelHash))
+
+    # the open classes: every label seen with an UNK category
+    openClasses = np.unique(np.concatenate([self._column(x) for x in categories])) if categories else self._all
+    self._open = openClasses if len(openClasses) else self._all
+    self._cache = common.LRUCache() # word -> candidates
+
+  """ Build the tag dictionary of a trained VisibleDataHMM, from its emission counts n_y,x """
+  @staticmethod
+  def fromVisible(model, fallback=DFLT_FALLBACK):
+    n_yx = model.getVisibleCounts()[0]
+    columns, labels = np.nonzero(n_yx.T > 0) # sorted by column, then label
+    indptr = np.zeros(n_yx.shape[1]+1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(columns, minlength=n_yx.shape[1]))
+
+    vocab, unker = model.getVocabulary(), model.getUnker()
+    categories = set(unker.unkCategory(word) for word in unker.getCounts())
+    categories = [vocab.getId(category) for category in categories if category in vocab]
+    return TagDictionary(model.getLabelHash(), vocab, indptr, labels.astype(np.intp), unker, categories, fallback)
+
+  """ Return the candidates of word id x (possibly none) """
+  def _column(self, x):
+    return self._indices[self._indptr[x]:self._indptr[x+1]]
+
+  """ Return the int ids of the candidate labels of a word, sorted """
+  def getCandidates(self, word):
+    candidates = self._cache.get(word)
+    if candidates is not None:
+      return candidates
+
+    x = self._vocab.getId(word)
+    if x is not None and x < len(self._indptr)-1:
+      candidates = self._column(x)
+    if candidates is None or not len(candidates):
+      if self._fallback == "category":
+        x = self._vocab.getId(self._unker.unkCategory(word))
+        candidates = self._column(x) if x is not None and x < len(self._indptr)-1 else None
+        if candidates is None or not len(candidates):
+          candidates = self._open
+      elif self._fallback == "open":
+        candidates = self._open
+      else:
+        candidates = self._all
+
+    self._cache.put(word, candidates)
+    return candidates
+
+  """ Return a copy of the mapping of str label -> int id that candidates are given in """
+  def getLabelHash(self):
+    return dict(self._labelHash)
+
+  """ Return the mean number of candidates of the words of sentences (each a list) """
+  def meanCandidates(self, sentences):
+    sizes = [len(self.getCandidates(word)) for sentence in sentences for word in sentence]
+    return float(sum(sizes))/len(sizes) if sizes else 0.0
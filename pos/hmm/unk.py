@@ -1,16 +1,23 @@
 # -*- coding: utf-8 -*-
 
-from rules import listToRuleset
+import numpy as np
+
+from rules import EndsWith, RuleClassifier
+from corpus import Corpus
 
 class AbstractUnker:
+  _classifiers = {} # Unker class -> its compiled rules, see __init__()
+
   """ Initialise the class with:
-        corpus: a list of sentences - each sentence a list of words - the corpus to substitute UNKs for
+        corpus: a list of sentences - each sentence a list of words - the corpus to substitute UNKs for.
+                Can be any iterable of sentences, e.g. a corpus.StreamedCorpus streaming from disk,
+                or a Corpus, which the HMMs then use as it is.
         counts: a dictionary mapping word->count
         unk_thresh: threshold count for when a word should be UNKed
                     i.e. only substitute UNK for words with count<=unk_thresh
 
-      The corpus is processed in this __init__ method, which will take approx. O(n) time
-       for n words in the corpus.
+      The corpus is processed lazily, as getUnkedCorpus() is iterated over, so no UNKed
+       copy of the corpus is kept.
   """
   def __init__(self, corpus, counts, unk_thresh=1):
     self._corpus = corpus
@@ -20,11 +27,14 @@ class AbstractUnker:
     # _abstractGuard() should init self._rulesList in subclasses
     self._rulesList = None
 
-    self._unkedCorpus = None # initialised in _processCorpus()
-
     self._abstractGuard() # raise error only if self is AbstractUnker but not a subclass
-    self._rulesetHead = listToRuleset(self._rulesList)
-    self._processCorpus()
+
+    # the rules of an Unker class are fixed, so its instances share one compiled (and memoised)
+    #  classifier, e.g. the unkers of each fold of a cross-validation:
+    cls = self.__class__
+    if cls not in AbstractUnker._classifiers:
+      AbstractUnker._classifiers[cls] = RuleClassifier(self._rulesList, "*U*") # catchall UNK category
+    self._classifier = AbstractUnker._classifiers[cls]
 
 
   """ OVERRIDE THIS IN ALL SUBCLASSES!! """
@@ -35,38 +45,30 @@ class AbstractUnker:
       which category of UNK applies based on this Unker's rules
   """
   def _categoriseUnk(self, word):
-    ruleset = self._rulesetHead # get the list of rules we need to apply
-
-    # while there are still rules to evaluate:
-    unk = "*U*" # catchall UNK category
-    while ruleset is not None:
-      rule = ruleset.getRule()
-      if rule.appliesTo(word):
-        unk = rule.execute()
-        break # stop at first applicable UNK substitution
-
-      ruleset = ruleset.nextRule() # otherwise, keep looking
-
-    return unk
-
-  """ Process the corpus, internally store the corpus w. UNK substitutions """
-  def _processCorpus(self):
-    res = [] # will be a copy of the original corpus but with any UNK substitutions
+    return self._classifier.classify(word) # the first applicable UNK substitution
 
-    for line in self._corpus:
-      newl = [] # the new line with UNK substituted
+  """ Return a word of the corpus, or its UNK category if the word's count is below threshold """
+  def unkWord(self, word):
+    # substitute UNK only if below threshold
+    if self._counts[word] <= self._thresh:
+      return self._categoriseUnk(word)
 
-      for word in line:
-        # substitute UNK only if below threshold
-        if self._counts[word] <= self._thresh:
-          before = word
-          word = self._categoriseUnk(word)
+    return word
 
-        newl.append(word) # append this word (poss. with sub.)
+  """ Return the UNK category a word is substituted with when it is UNKed, whatever its count """
+  def unkCategory(self, word):
+    return self._categoriseUnk(word)
 
-      res.append(newl) # append this line to the resulting list
+  """ Return the id in vocab of the UNKed form of each of words, e.g. a whole training vocabulary,
+       adding UNK categories to vocab as needed. Encode a corpus by its original words, then
+       map the ids through this, to UNK each distinct word only once.
+  """
+  def unkIds(self, words, vocab):
+    return np.array([vocab.add(self.unkWord(word)) for word in words], dtype=np.int32)
 
-    self._unkedCorpus = res
+  """ Return a sentence (list of words) of the corpus, with UNKs substituted as necessary """
+  def unkSentence(self, sentence):
+    return [self.unkWord(word) for word in sentence]
 
   """ Check if a word is not in the dictionary (i.e. it is unknown)
        and return the properly Unked form. Otherwise return the word.
@@ -77,16 +79,32 @@ class AbstractUnker:
 
     return word
 
-  """ Return the corpus with UNKs substituted as necessary """
+  """ Forget the memoised UNK categories, shared by every unker of this class """
+  def clearCache(self):
+    self._classifier.clearCache()
+
+  """ Return the dictionary mapping word->count that words are evaluated against """
+  def getCounts(self):
+    return self._counts
+
+  """ Return the threshold count at or below which a word is UNKed """
+  def getThreshold(self):
+    return self._thresh
+
+  """ Return the corpus with UNKs substituted as necessary, as a generator of sentences
+       which processes the corpus as it goes.
+  """
   def getUnkedCorpus(self):
-    return self._unkedCorpus
+    return (self.unkSentence(line) for line in self._corpus)
 
   """ Return the original word found in the jth position of the ith
-       sentence of the unmodified corpus.
+       sentence of the unmodified corpus (which must then be a list or a Corpus).
        e.g. getOrigWord(0,1) will return "world"
             for corpus=[["hello", "world"],["demo", "example"]]
   """
   def getOrigWord(self, i, j):
+    if isinstance(self._corpus, Corpus):
+      return self._corpus.getOrigWord(i, j)
     return self._corpus[i][j]
 
   """ Return the original corpus without any UNK substitutions """
@@ -123,26 +141,24 @@ class PratyayaUnker(AbstractUnker):
     _i, Ui = "i", "*Ui*" # 7. vibh. sing.
     _I, UI = "\xc4\xab", "*UI*" # 1. vibh. sing. fem.
 
-    wordEnds = lambda w,s: w[-len(s):] == s
-
-    self._rulesList = [(lambda w: wordEnds(w, _asya), Uasya),
-                       (lambda w: wordEnds(w, _ena) or wordEnds(w, _eNa), Uena),
-                       (lambda w: wordEnds(w, _su) or wordEnds(w, _Su), Usu),
-                       (lambda w: wordEnds(w, _as), Uas),
-                       (lambda w: wordEnds(w, _As), UAs),
-                       (lambda w: wordEnds(w, _am) or wordEnds(w, _aM), Uam),
-                       (lambda w: wordEnds(w, _Am) or wordEnds(w, _AM), UAm),
-                       (lambda w: wordEnds(w, _au), Uau),
-                       (lambda w: wordEnds(w, _is), Uis),
-                       (lambda w: wordEnds(w, _os), Uos),
-                       (lambda w: wordEnds(w, _At), UAt),
-                       (lambda w: wordEnds(w, _at), Uat),
-                       (lambda w: wordEnds(w, _vA) or wordEnds(w, _tyA), UvA),
-                       (lambda w: wordEnds(w, _A), UA),
-                       (lambda w: wordEnds(w, _e), Ue),
-                       (lambda w: wordEnds(w, _s), Us),
-                       (lambda w: wordEnds(w, _i), Ui),
-                       (lambda w: wordEnds(w, _I), UI)]
+    self._rulesList = [(EndsWith(_asya), Uasya),
+                       (EndsWith(_ena, _eNa), Uena),
+                       (EndsWith(_su, _Su), Usu),
+                       (EndsWith(_as), Uas),
+                       (EndsWith(_As), UAs),
+                       (EndsWith(_am, _aM), Uam),
+                       (EndsWith(_Am, _AM), UAm),
+                       (EndsWith(_au), Uau),
+                       (EndsWith(_is), Uis),
+                       (EndsWith(_os), Uos),
+                       (EndsWith(_At), UAt),
+                       (EndsWith(_at), Uat),
+                       (EndsWith(_vA, _tyA), UvA),
+                       (EndsWith(_A), UA),
+                       (EndsWith(_e), Ue),
+                       (EndsWith(_s), Us),
+                       (EndsWith(_i), Ui),
+                       (EndsWith(_I), UI)]
 
 """ A basic Unker class that uses only one UNK category. Also a reference
     implementation for AbstractUnker.
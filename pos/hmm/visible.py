@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
 import itertools
 import numpy as np
 import sys
 
 from . import _common as common
+from . import metrics
 from . import unk
+from .corpus import Corpus
 
 """ A Hidden Markov Model constructed from visible data """
 class VisibleDataHMM:
@@ -14,21 +15,30 @@ class VisibleDataHMM:
   """ Construct the HMM object using the outputs and labels (and wordcounts)
         unker: A subclass inheriting from AbstractUnker
         tags: A list of tag sequences (should correspond to the structure of
-              the word corpus i.e. a list of sentences-as-lists)
+              the word corpus i.e. a list of sentences-as-lists). Can be any
+              iterable of tag sequences, e.g. a utils.Reiterable streaming from disk.
+              Ignored (pass None) if the unker's corpus is a tagged Corpus.
         wordCount: count of unique words in the corpus
+
+      The corpus is read once, and kept only as a Corpus of word and label ids.
   """
   def __init__(self, unker, tags, wordCount):
-    # hash x for compatibility with HiddenDataHMM:
-    self._outputs = [[hash(x) for x in sentence] for sentence in unker.getUnkedCorpus()]
     self._unker = unker # keep the unker so we can also count the original words
-    self._labels = tags # list of list of states
     self._wc = wordCount
 
+    # encode x as a vocabulary id for compatibility with HiddenDataHMM, and y as a label id:
+    corpus = unker.getOrigCorpus()
+    if not (isinstance(corpus, Corpus) and corpus.isTagged()):
+      corpus = Corpus.fromSentences(corpus, tags)
+    self._corpus = corpus
+    self._vocab = corpus.getVocabulary()
+    self._tagVocab = corpus.getTagVocabulary()
+
     self._sigma = None # not yet defined - don't know how many states there are
     self._tau = None # also not yet defined, need n_ycirc
-    self.n_sentences = len(tags)
-    if self.n_sentences != len(self._outputs): # problem
-      raise ValueError("Outputs and labels should be the same size")
+    self.n_sentences = len(corpus)
+    self._holdOutCounts = None # built by the first holdOut()
+    self._tauCache = common.LRUCache() # UNKed x -> tau_{.,x}
 
   """ Train the HMM by building the sigma and tau mappings.
         - params is an alpha value to use (default is 1.0)
@@ -36,61 +46,114 @@ class VisibleDataHMM:
   def train(self, params=1.0):
     self._alpha = params # add-alpha smoothing
 
-    n_yy_ = defaultdict(int) # n_y,y' (number of times y' follows y)
-    n_ycirc = defaultdict(int) # n_y,o (number of times any label follows y)
-    n_yx = defaultdict(int) # n_y,x (number of times label y labels output x)
-
-    # build counts
-    for i in xrange(len(self._outputs)): # iterate over each sentence
-      words = self._outputs[i]
-      tags = self._labels[i]
-      n = len(words)
-      for j in xrange(0, n - 1): # iterate over each word/tag in the sequence
-        y = tags[j]
-        y_ = tags[j+1] # y_ = y'
-        ytuple = (y,y_) # label transition
-
-        x = words[j] # corresponding output
-        orig = hash(self._unker.getOrigWord(i,j)) # hash this!
-        if x != orig: # this word was UNKed
-          yorig = (y,orig)
-          n_yx[yorig] += 1 # keep track of the original word, too
-          
-        yxtuple = (y,x) # emission
-
-        # increment the number of times we've seen these:
-        n_yy_[ytuple] += 1
-        n_ycirc[y] += 1
-
-        n_yx[yxtuple] += 1
-
     # properties of this HMM:
-    self.tagset = n_ycirc.keys()
-    self._labelHash = common.makeLabelHash(self.tagset)
+    self.tagset = list(self._tagVocab)
+    self._labelHash = common.makeLabelHash(self.tagset) # label ids index the tagset
     self.tagsetSize = len(self.tagset)
 
-    # compute sigma matrix:
-    self._sigma = np.zeros([self.tagsetSize]*2)
-    for y in self.tagset: # first, set up smoothing:
-      yhash = self._labelHash[y]
-      sigmaSmoothUnk = self._alpha/(n_ycirc[y]+self._alpha*self.tagsetSize)
-      self._sigma[yhash,:] = sigmaSmoothUnk # smooth sigma if the pair (y,y') dne
-    for pair,count in n_yy_.iteritems(): # next, initialise sigmas for known (y,y') pairs
-      y,yprime = pair
-      yhash, yprimehash = self._labelHash[y],self._labelHash[yprime]
-      self._sigma[yhash,yprimehash] = (count+self._alpha)/(n_ycirc[y]+self._alpha*self.tagsetSize)
-    
-    # compute tau dict:
-    self._n_yx = defaultdict(float)
-    self._tau = common.TauDict(self._alpha, n_ycirc, self._wc)
-    for pair,count in n_yx.iteritems():
-      y,x = pair
-      yhash = self._labelHash[y]
-      self._tau[(yhash,x)] = (count+self._alpha)/(n_ycirc[y]+self._alpha*self.tagsetSize) # smooth
-      self._n_yx[(yhash,x)] = count # class-wide dict should use hashed labels
-
-    self._n_yy_ = n_yy_
-    self._n_ycirc = n_ycirc
+    # UNK substitution only depends on the word, so map each word id to the id of its UNKed form:
+    with metrics.getMetrics().phase("unk", words=len(self._vocab)):
+      unked = self._unker.unkIds(list(self._vocab), self._vocab)
+
+    ys, ys_, origs = self._flatten()
+    xs = unked[origs] # corresponding output
+    wasUnked = xs != origs # these words were UNKed, keep track of the original word, too
+
+    # build counts:
+    T, V = self.tagsetSize, len(self._vocab)
+    n_yy_ = np.bincount(ys*T + ys_, minlength=T*T).reshape(T,T) # n_y,y' (number of times y' follows y)
+    n_ycirc = np.bincount(ys, minlength=T) # n_y,o (number of times any label follows y)
+    n_yx = np.bincount(ys.astype(np.int64)*V + xs, minlength=T*V) # n_y,x (number of times label y labels output x)
+    n_yx += np.bincount(ys[wasUnked].astype(np.int64)*V + origs[wasUnked], minlength=T*V)
+    n_yx = n_yx.reshape(T,V)
+
+    # compute sigma matrix, smoothed if the pair (y,y') dne:
+    self._sigma = (n_yy_ + self._alpha)/(n_ycirc[:,np.newaxis] + self._alpha*T).astype(float)
+
+    # compute tau matrix, with each row smoothed for the (y,x) pairs that dne:
+    self._tauSmooth = self._alpha/(n_ycirc + self._alpha*self._wc).astype(float) # also for x not in vocab
+    self._tau = np.where(n_yx > 0,
+                         (n_yx + self._alpha)/(n_ycirc[:,np.newaxis] + self._alpha*T).astype(float),
+                         self._tauSmooth[:,np.newaxis])
+
+    self._tauCache.clear() # tau has changed
+    self._n_yx = n_yx.astype(float)
+    self._n_yy_ = n_yy_.astype(float)
+    self._n_ycirc = n_ycirc.astype(float)
+
+  """ Gather every (y, y', x) of the given sentences (by index, default all) as flat arrays of ints,
+       where x is the original (not UNKed) word id
+  """
+  def _flatten(self, sentences=None):
+    i = self._corpus.positions(sentences, transitions=True) # every word but each sentence's last
+    tags = self._corpus.getTags()
+    return tags[i], tags[i+1], self._corpus.getOrigs()[i] # y, y' and the (original) output of y
+
+  """ Count what holdOut() subtracts from: the n_y,x of each original word, each word's count,
+       and the vocabulary id of each word's UNK category. Held out models share these.
+      Done by the first holdOut(), or beforehand e.g. so that forked worker processes share them.
+  """
+  def prepareHoldOut(self):
+    # a copy of the vocabulary, extended with the UNK category of every word, since any
+    #  word can fall below the UNK threshold once sentences are held out:
+    vocab = common.Vocabulary(self._vocab)
+    category = np.array([vocab.add(self._unker.unkCategory(vocab.getWord(x)))
+                         for x in xrange(len(self._vocab))], dtype=np.int32)
+
+    T, V = self.tagsetSize, len(vocab)
+    ys, _, origs = self._flatten()
+    n_yxo = np.bincount(ys.astype(np.int64)*V + origs, minlength=T*V).reshape(T,V).astype(float)
+    counts = np.bincount(self._corpus.getOrigs(), minlength=V) # every word, incl. the final STOP
+    n_yx = np.zeros([T, V])
+    n_yx[:,:len(self._vocab)] = self._n_yx
+    labelCounts = np.bincount(self._corpus.getTags(), minlength=T)
+
+    self._holdOutCounts = (vocab, category, counts, n_yxo, n_yx, labelCounts)
+
+  """ Return the model this HMM would be had it not been trained on the given sentences (by index),
+       e.g. for cross-validation. The held out sentences' counts are subtracted from this
+       (trained) model's, so this costs time in the size of the held out sentences only.
+      Return: a HeldOutHMM, which can be decoded with like this model
+  """
+  def holdOut(self, sentences):
+    if self._holdOutCounts is None:
+      self.prepareHoldOut()
+    vocab, category, counts, n_yxo, n_yx, labelCounts = self._holdOutCounts
+    T = self.tagsetSize
+
+    ys, ys_, origs = self._flatten(sentences)
+    n_yy_ = self._n_yy_ - np.bincount(ys*T + ys_, minlength=T*T).reshape(T,T)
+    n_ycirc = self._n_ycirc - np.bincount(ys, minlength=T)
+
+    # labels only seen in the held out sentences aren't labels of the held out model:
+    held = self._corpus.positions(sentences)
+    labels = labelCounts - np.bincount(self._corpus.getTags()[held], minlength=T) > 0
+
+    # the held out words, and how many times each is held out:
+    words, removed = np.unique(self._corpus.getOrigs()[held], return_counts=True)
+    wc = self._wc - removed.sum()
+
+    # n_y,x of each held out (original) word, with and without the held out sentences:
+    n_yxoAll = n_yxo[:,words]
+    n_yxoKept = np.copy(n_yxoAll)
+    np.subtract.at(n_yxoKept, (ys, np.searchsorted(words, origs)), 1)
+
+    # only the held out words can change UNK substitution, so only the columns of these words
+    #  and their UNK categories change: take out the words' counts as trained, put the rest back
+    thresh = self._unker.getThreshold()
+    unkedAll = np.where(counts[words] <= thresh, category[words], words)
+    unkedKept = np.where(counts[words] - removed <= thresh, category[words], words)
+    wasUnked, isUnked = unkedAll != words, unkedKept != words
+    columns = np.concatenate([unkedAll, words[wasUnked], unkedKept, words[isUnked]])
+    deltas = np.concatenate([-n_yxoAll, -n_yxoAll[:,wasUnked], n_yxoKept, n_yxoKept[:,isUnked]], axis=1)
+
+    columns, where = np.unique(columns, return_inverse=True)
+    changed = n_yx[:,columns]
+    np.add.at(changed.T, where, deltas.T)
+
+    unker = self._unker.__class__([], HeldOutCounts(vocab, counts, dict(itertools.izip(words.tolist(), removed.tolist()))), thresh)
+    return HeldOutHMM(self._labelHash, labels, self._alpha, vocab, unker, wc, n_yx,
+                      dict(itertools.izip(columns.tolist(), changed.T)), n_yy_, n_ycirc)
 
   """ Return the sigma_{y,y'} for given y and y' - or 0 if dne """
   def getSigma(self, y, yprime):
@@ -100,9 +163,25 @@ class VisibleDataHMM:
 
   """ Return the tau_{y,x} for given y and x - or 0 if dne """
   def getTau(self, y, x):
-    y = self._labelHash[y]
-    x = hash(self._unker.evaluateWord(x)) # check if x should be unked and hash
-    return self._tau[(y,x)]
+    return self.getTauVector(x)[self._labelHash[y]]
+
+  """ Return tau_{y,x} for every label y of the tau column x """
+  def _tauOfColumn(self, x):
+    return np.ascontiguousarray(self._tau[:,x])
+
+  """ Return tau_{y,x} for every label y of a given x, as a vector indexed by int label.
+      Vectors are cached by the UNKed form of x, since most outputs of a corpus are a few common words.
+  """
+  def getTauVector(self, x):
+    return common.cachedTauVector(x, self._unker, self._vocab, self._tauCache, self._tauSmooth, self._tauOfColumn)
+
+  """ Return the (hits, misses) of the cache of getTauVector() """
+  def getTauCacheStats(self):
+    return self._tauCache.getStats()
+
+  """ Return tau_{y,x} for every label y of an x not in the vocabulary """
+  def getTauSmoothing(self):
+    return self._tauSmooth
 
   """ Return a copy of the labels of this HMM """
   def getLabels(self):
@@ -112,6 +191,14 @@ class VisibleDataHMM:
   def getLabelHash(self):
     return dict(self._labelHash)
 
+  """ Return the vocabulary mapping each output x to its column in the tau matrix """
+  def getVocabulary(self):
+    return self._vocab
+
+  """ Return the unker used to evaluate outputs """
+  def getUnker(self):
+    return self._unker
+
   """ Return the trained internal distributions sigma and tau """
   def getDistribution(self):
     return (self._sigma, self._tau)
@@ -120,18 +207,113 @@ class VisibleDataHMM:
   def getWordCount(self):
     return self._wc
 
-  """ Return the transition/emission counts from the visible data.
-      Converts n_y,y' and n_y,o to numpy arrays (nxn and 1xn resp.)
+  """ Return copies of the transition/emission counts from the visible data,
+       n_y,x, n_y,y' and n_y,o as numpy arrays (TxV, TxT and 1xT resp.)
   """
   def getVisibleCounts(self):
-    n_yy_mat = np.zeros([self.tagsetSize]*2)
-    n_ycircmat = np.zeros(self.tagsetSize)
+    return (np.copy(self._n_yx), np.copy(self._n_yy_), np.copy(self._n_ycirc))
+
+""" Word counts of a VisibleDataHMM's corpus with some sentences held out: the counts of the
+     corpus, backed by a Vocabulary, less the counts of the held out words. Words whose count
+     drops to 0 are no longer in the counts, as if they had never been seen.
+"""
+class HeldOutCounts:
+
+  """ vocab: a Vocabulary, counts: word id -> count, removed: dict of word id -> count held out """
+  def __init__(self, vocab, counts, removed):
+    self._vocab = vocab
+    self._counts = counts
+    self._removed = removed
+
+  def _count(self, word):
+    i = self._vocab.getId(word)
+    if i is None or i >= len(self._counts):
+      return 0
+    return int(self._counts[i]) - self._removed.get(i, 0)
+
+  def __getitem__(self, word):
+    count = self._count(word)
+    if count <= 0:
+      raise KeyError(word)
+    return count
+
+  def __contains__(self, word):
+    return self._count(word) > 0
+
+  def __iter__(self):
+    return (word for word in self._vocab if word in self)
+
+  def keys(self):
+    return list(self)
+
+""" A VisibleDataHMM with some of its sentences held out, see VisibleDataHMM.holdOut().
+    Rather than a dense tau matrix, it keeps the n_y,x counts of the full model along with
+     the columns that differ, and computes the tau column of an output as it is decoded.
+    It keeps the full model's labels, but those not in its own corpus (labels is False) can't
+     be transitioned into, as if they weren't labels at all.
+"""
+class HeldOutHMM:
+
+  def __init__(self, labelHash, labels, alpha, vocab, unker, wordCount, n_yx, changed, n_yy_, n_ycirc):
+    self._labelHash = labelHash
+    self._alpha = alpha
+    self._vocab = vocab
+    self._unker = unker
+    self._wc = wordCount
+    self._n_yx = n_yx # shared with the full model, not to be modified
+    self._changed = changed # column x -> n_y,x vector, where it differs from n_yx
+    T = np.count_nonzero(labels)
+
+    self._norm = n_ycirc + self._alpha*T # the denominator of both sigma and tau
+    self._sigma = (n_yy_ + self._alpha)/self._norm[:,np.newaxis]
+    self._sigma[:,~labels] = 0.0
+    self._tauSmooth = self._alpha/(n_ycirc + self._alpha*self._wc)
+    self._tauCache = common.LRUCache() # UNKed x -> tau_{.,x}
+
+  """ Return tau_{y,x} for every label y of the tau column x """
+  def _tauOfColumn(self, x):
+    n_yx = self._changed.get(x)
+    if n_yx is None:
+      n_yx = self._n_yx[:,x]
+    return np.where(n_yx > 0, (n_yx + self._alpha)/self._norm, self._tauSmooth)
+
+  """ Return tau_{y,x} for every label y of a given x, as a vector indexed by int label,
+       cached by the UNKed form of x
+  """
+  def getTauVector(self, x):
+    return common.cachedTauVector(x, self._unker, self._vocab, self._tauCache, self._tauSmooth, self._tauOfColumn)
 
-    """ Iterate through n_yy and copy into array matrix """
-    for pair,count in self._n_yy_.iteritems():
-        y,yprime = pair
-        yhash, yprimehash = self._labelHash[y], self._labelHash[yprime]
-        n_yy_mat[yhash,yprimehash] = count
-        n_ycircmat[yhash] += count
+  """ Return the (hits, misses) of the cache of getTauVector() """
+  def getTauCacheStats(self):
+    return self._tauCache.getStats()
 
-    return (self._n_yx, n_yy_mat, n_ycircmat)
+  """ Return tau_{y,x} for every label y of an x not in the vocabulary """
+  def getTauSmoothing(self):
+    return self._tauSmooth
+
+  """ Return a copy of the labels of this HMM """
+  def getLabels(self):
+    return set(self._labelHash)
+
+  """ Return a copy of the internal mapping of str y -> int i """
+  def getLabelHash(self):
+    return dict(self._labelHash)
+
+  """ Return the vocabulary mapping each output x to its column in the tau matrix """
+  def getVocabulary(self):
+    return self._vocab
+
+  """ Return the unker used to evaluate outputs """
+  def getUnker(self):
+    return self._unker
+
+  """ Return the internal distributions sigma and tau. Tau is built in full, column by column """
+  def getDistribution(self):
+    tau = np.empty(self._n_yx.shape)
+    for x in xrange(tau.shape[1]):
+      tau[:,x] = self._tauOfColumn(x)
+    return (self._sigma, tau)
+
+  """ Return the number of words in this HMM's corpus """
+  def getWordCount(self):
+    return self._wc
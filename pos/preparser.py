@@ -2,6 +2,13 @@
 import re
 import itertools
 from hmm import STOP
+from hmm.corpus import Corpus
+from utils import CorpusReader
+
+# "WORD[TAG]" of the Sanskrit JNU format: the words, the tags, and both in one pass
+_JNU_WORD = re.compile(r"([^\s\]]*?)\[")
+_JNU_TAG = re.compile(r"\[(.*?)\]")
+_JNU_WORD_TAG = re.compile(r"([^\s\]]*?)\[(.*?)\]")
 
 """ This class lays out the general interface for a preparser and implements some common
     methods.
@@ -17,24 +24,53 @@ class AbstractPreparser:
     tags = []
 
     try:
-      for line in self._rawdata:
-        line = "%s %s %s" % (self._stopPair, line, self._stopPair)
-        words.append(self.getSentenceWords(line))
-        tags.append(self.getSentenceTags(line))
+      for sentenceWords,sentenceTags in self.iterWordsTags():
+        words.append(sentenceWords)
+        tags.append(sentenceTags)
 
-    except IndexError:
+    except (IndexError, ValueError):
       return None
 
     return words,tags
 
+  """ Lazily parse the outputs and tags, yielding the (words, tags) of one sentence at a time.
+      Raises ValueError if a sentence is badly formatted i.e. words and tags don't pair up.
+  """
+  def iterWordsTags(self):
+    for line in self._rawdata:
+      line = "%s %s %s" % (self._stopPair, line, self._stopPair)
+      words,tags = self.getSentenceWordsTags(line)
+      if len(words) != len(tags):
+        raise ValueError("Bad format: %s" % " ".join(line.split()))
+
+      yield words,tags
+
+  """ Parse the files of a corpus in bulk, yielding the words of one sentence at a time as an array
+       of ids, encoded by the Vocabulary vocab (which is extended as needed). Nothing is kept in
+       memory, so that a corpus can be streamed from disk (see corpus.StreamedCorpus).
+  """
+  @classmethod
+  def parseFile(cls, files, vocab):
+    for words in cls(CorpusReader(files)).iterWords():
+      yield vocab.encode(words)
+
+  """ Parse the corpus in one pass into a Corpus of word (and if tagged, tag) ids.
+      Raises ValueError if tagged and a sentence is badly formatted, as iterWordsTags() does.
+  """
+  def parseCorpus(self, tagged=True):
+    if tagged:
+      return Corpus.fromWordsTags(self.iterWordsTags())
+    return Corpus.fromSentences(self.iterWords())
+
   """ For use when just the words are desired from a corpus. Aka just tokenise the sentences."""
   def parseWords(self):
-    words = []
+    return list(self.iterWords())
+
+  """ Lazily tokenise the sentences, yielding the words of one sentence at a time. """
+  def iterWords(self):
     for line in self._rawdata:
       line = "%s %s %s" % (STOP, line, STOP)
-      words.append(line.split())
-
-    return words
+      yield line.split()
 
   def writeCorpusWithoutTags(self, out):
     raise NotImplementedError('Subclasses must override this method!')
@@ -44,6 +80,10 @@ class AbstractPreparser:
   @staticmethod
   def getSentenceTags(line):
     raise NotImplementedError('Subclasses must override this method!')
+  """ Return (getSentenceWords(line), getSentenceTags(line)), in a single pass where possible """
+  @classmethod
+  def getSentenceWordsTags(cls, line):
+    return cls.getSentenceWords(line), cls.getSentenceTags(line)
   @staticmethod
   def formatOutput(words, tags):
     raise NotImplementedError('Subclasses must override this method!')
@@ -65,10 +105,15 @@ class EnglishWSJParser(AbstractPreparser):
   def getSentenceTags(line):
     return line.split()[1::2]
 
+  @classmethod
+  def getSentenceWordsTags(cls, line):
+    tokens = line.split()
+    return tokens[::2], tokens[1::2]
+
   def writeCorpusWithoutTags(self, out):
     f = open(out, 'w')
     for line in self._rawdata:
-      words = cls.getSentenceWords(line)
+      words = self.getSentenceWords(line)
       for word in words:
         f.write("%s "%word)
       f.write("\n")
@@ -76,11 +121,7 @@ class EnglishWSJParser(AbstractPreparser):
 
   @staticmethod
   def formatOutput(words, tags):
-    output = ""
-    for word,tag in itertools.izip(words, tags):
-      output += word + " " + tag + " "
-
-    return output
+    return "".join([word + " " + tag + " " for word,tag in itertools.izip(words, tags)])
 
 class SanskritJNUParser(AbstractPreparser):
   
@@ -95,7 +136,7 @@ class SanskritJNUParser(AbstractPreparser):
     # capturing group before a literal '[' char:
     #  match at least 0 times,lazy, on a group consisting of:
     #   not whitespace, not a ']' char
-    return re.findall(r"([^\s\]]*?)\[", line)
+    return _JNU_WORD.findall(line)
 
   @staticmethod
   def getSentenceTags(line):
@@ -104,7 +145,17 @@ class SanskritJNUParser(AbstractPreparser):
     # capturing group before a literal '[' char:
     #  match at least 0 times,lazy, on a group consisting of:
     #   not whitespace, not a ']' char
-    return re.findall(r"\[(.*?)\]", line)
+    return _JNU_TAG.findall(line)
+
+  @classmethod
+  def getSentenceWordsTags(cls, line):
+    pairs = _JNU_WORD_TAG.findall(line)
+    # every '[' starts a word, so if each one also starts a pair, the single pass agrees with
+    #  getSentenceWords() and getSentenceTags(). Otherwise, leave it to them to tell what's wrong:
+    if len(pairs) != line.count("["):
+      return cls.getSentenceWords(line), cls.getSentenceTags(line)
+
+    return [word for word,_ in pairs], [tag for _,tag in pairs]
 
   def writeCorpusWithoutTags(self, out):
     f = open(out, 'w')
@@ -117,11 +168,6 @@ class SanskritJNUParser(AbstractPreparser):
 
   @staticmethod
   def formatOutput(words, tags):
-    n = len(words)
-    output = ""
-    for i in xrange(0, n):
-      output += "%s[%s] " % (words[i], tags[i])
-
-    return output
+    return "".join(["%s[%s] " % (word, tag) for word,tag in itertools.izip(words, tags)])
 
     
@@ -0,0 +1,124 @@
+# Profiling of selected phases of a run (see hmm.metrics), and reports of the results
+import cProfile
+import os
+import pstats
+import sys
+
+DFLT_TOP = 20 # hot functions listed per phase
+DFLT_SORT = "tottime"
+MAX_STACK_DEPTH = 64 # collapsed stacks are cut off below this depth (and at recursion)
+MIN_STACK_SECONDS = 1e-6 # and at calls taking less than this on the stack
+
+""" Profiles the phases of a run whose names are given (or every phase, if phases is None),
+     with one cProfile.Profile per phase name, accumulated over every time the phase runs
+     (e.g. every iteration's E-step).
+    Attach it to a Metrics with Metrics.setProfiler(), which starts and stops it around phases.
+    Only one phase is profiled at a time: a phase nested in one being profiled is already
+     covered by it, so it isn't profiled separately.
+"""
+class PhaseProfiler:
+
+  """ phases: names of the phases to profile, or None for all
+      outDir: directory to write each phase's <phase>.pstats and <phase>.collapsed to
+      top: number of hot functions to summarise per phase
+  """
+  def __init__(self, phases, outDir, top=DFLT_TOP):
+    self._phases = set(phases) if phases is not None else None
+    self._outDir = outDir
+    self._top = top
+    self._profiles = {} # phase name -> cProfile.Profile
+    self._order = [] # phase names, in the order they were first profiled
+    self._active = None # name of the phase being profiled
+
+  """ Start profiling a phase, if it is selected and no other phase is being profiled.
+      Return: True if it is being profiled, so that stop() should be called at its end
+  """
+  def start(self, name):
+    if self._active is not None or (self._phases is not None and name not in self._phases):
+      return False
+
+    if name not in self._profiles:
+      self._profiles[name] = cProfile.Profile()
+      self._order.append(name)
+    self._active = name
+    self._profiles[name].enable()
+    return True
+
+  def stop(self, name):
+    if self._active == name:
+      self._profiles[name].disable()
+      self._active = None
+
+  """ Write the pstats and collapsed stacks of every profiled phase to the output directory,
+       and a summary of each phase's hot functions to out. Return: the paths written
+  """
+  def finish(self, out=sys.stdout):
+    if self._active is not None: # e.g. on exit mid-phase
+      self.stop(self._active)
+    if not self._profiles:
+      return []
+
+    if not os.path.isdir(self._outDir):
+      os.makedirs(self._outDir)
+    written = []
+    for name in self._order:
+      path = os.path.join(self._outDir, name)
+      self._profiles[name].dump_stats(path + ".pstats")
+      stats = pstats.Stats(path + ".pstats", stream=out)
+      writeCollapsed(stats, path + ".collapsed")
+      written += [path + ".pstats", path + ".collapsed"]
+
+      out.write("\n==== profile of phase '%s' (%s.pstats) ====\n" % (name, path))
+      printTop(stats, self._top)
+
+    return written
+
+""" Print the top hot functions of pstats.Stats (all, if top is None), to the stream of the stats """
+def printTop(stats, top=DFLT_TOP, sort=DFLT_SORT):
+  stats.strip_dirs().sort_stats(sort).print_stats(*([top] if top is not None else []))
+
+""" Return a function's name as a frame of a collapsed stack: file:line(function) """
+def _frameName(func):
+  fname, line, name = func
+  if fname == "~": # a builtin
+    return name
+  return "%s:%i(%s)" % (os.path.basename(fname), line, name)
+
+""" Write pstats.Stats as collapsed stacks, "root;caller;callee microseconds" per line, as read
+     by flamegraph tools (e.g. flamegraph.pl, speedscope).
+    cProfile records only caller -> callee edges rather than whole stacks, so the stacks are
+     reconstructed from the roots down, dividing each function's time between its callers in
+     proportion to the time each call edge took: exact for call trees, approximate otherwise.
+"""
+def writeCollapsed(stats, fname):
+  callees = {} # func -> [(callee, cumulative seconds of the callee when called by func)]
+  roots = []
+  for func,(cc, nc, tt, ct, callers) in stats.stats.iteritems():
+    if not callers:
+      roots.append(func)
+    for caller,edge in callers.iteritems():
+      edgeTime = edge[3] if isinstance(edge, tuple) else 0.0 # (cc, nc, tt, ct) of the edge
+      callees.setdefault(caller, []).append((func, edgeTime))
+
+  stacks = {} # collapsed stack -> microseconds
+  def descend(func, seconds, stack):
+    cc, nc, tt, ct, callers = stats.stats[func]
+    stack = stack + [_frameName(func)]
+    share = seconds/ct if ct > 0 else 0.0 # the fraction of func's time spent on this stack
+    key = ";".join(stack)
+    stacks[key] = stacks.get(key, 0.0) + tt*share
+    if len(stack) >= MAX_STACK_DEPTH:
+      return
+    for callee,edgeTime in callees.get(func, []):
+      if _frameName(callee) not in stack and edgeTime*share >= MIN_STACK_SECONDS: # not into recursion
+        descend(callee, edgeTime*share, stack)
+
+  for root in roots:
+    descend(root, stats.stats[root][3], [])
+
+  f = open(fname, 'w')
+  for stack,seconds in sorted(stacks.iteritems()):
+    micros = int(round(seconds*1e6))
+    if micros > 0:
+      f.write("%s %i\n" % (stack, micros))
+  f.close()
@@ -0,0 +1,168 @@
+# A long-running tagging server: load or train a model once, then tag sentences sent
+#  over a local socket, decoding the sentences that arrive close together as one batch.
+#
+# Line protocol: the client sends one sentence per line, as whitespace-separated words,
+#  and receives one line per sentence, tagged in the format of the language's preparser.
+
+import os
+import sys
+import time
+import signal
+import socket
+import threading
+import Queue
+import SocketServer
+import numpy as np
+
+DFLT_BATCH_WINDOW = 0.005 # seconds the batcher waits for more sentences to join a batch
+DFLT_MAX_BATCH = 256 # max number of sentences decoded together
+DFLT_STATS_EVERY = 1000 # report latency every time this many sentences have been tagged
+
+""" A sentence waiting to be decoded, and its result once decoded """
+class _Request:
+
+  def __init__(self, words):
+    self.words = words
+    self.tags = None
+    self.received = time.time()
+    self.done = threading.Event()
+
+""" Gathers the sentences submitted within a short window of each other into micro-batches,
+     and decodes each batch on a single thread with ViterbiDecoder.decodeBatch.
+"""
+class MicroBatcher:
+
+  """ viterbi: a ViterbiDecoder
+      window: seconds to wait for more sentences after the first of a batch arrives
+      maxBatch: max number of sentences in a batch
+      statsEvery: report latency percentiles to log after this many sentences
+  """
+  def __init__(self, viterbi, window=DFLT_BATCH_WINDOW, maxBatch=DFLT_MAX_BATCH,
+               statsEvery=DFLT_STATS_EVERY, log=sys.stderr):
+    self._viterbi = viterbi
+    self._window = window
+    self._maxBatch = maxBatch
+    self._statsEvery = statsEvery
+    self._log = log
+
+    self._queue = Queue.Queue()
+    self._lock = threading.Lock() # guards the stats, which reportStats() may take from another thread
+    self._latencies = [] # seconds from receipt to result, since the last report
+    self._batches = 0
+
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  """ Decode a sentence (as a list of words). Blocks until its batch has been decoded. """
+  def decode(self, words):
+    request = _Request(words)
+    self._queue.put(request)
+    while not request.done.wait(1.0): # wait with a timeout so the caller stays interruptible
+      pass
+
+    return request.tags
+
+  """ Collect the next batch: block for its first sentence, then take what arrives in the window """
+  def _nextBatch(self):
+    batch = [self._queue.get()]
+    deadline = time.time() + self._window
+    while len(batch) < self._maxBatch:
+      timeout = deadline - time.time()
+      if timeout <= 0:
+        break
+      try:
+        batch.append(self._queue.get(timeout=timeout))
+      except Queue.Empty:
+        break
+
+    return batch
+
+  def _run(self):
+    while True:
+      batch = self._nextBatch()
+      try:
+        tagged = self._viterbi.decodeBatch([request.words for request in batch])
+      except Exception as e: # keep serving; the clients of this batch get no tags
+        self._log.write("Error decoding batch: %s\n" % e)
+        tagged = [None]*len(batch)
+
+      now = time.time()
+      with self._lock:
+        self._latencies.extend(now - request.received for request in batch)
+        self._batches += 1
+        report = len(self._latencies) >= self._statsEvery
+      for request,tags in zip(batch, tagged):
+        request.tags = tags
+        request.done.set()
+
+      if report:
+        self.reportStats()
+
+  """ Write the p50/p99 latency of the sentences tagged since the last report """
+  def reportStats(self):
+    with self._lock:
+      latencies, self._latencies = self._latencies, []
+      batches, self._batches = self._batches, 0
+    if not latencies:
+      return
+
+    p50, p99 = np.percentile(latencies, [50, 99])*1000.0
+    self._log.write("%i sentences in %i batches: p50 latency %.2fms, p99 latency %.2fms\n"
+                    % (len(latencies), batches, p50, p99))
+    self._log.flush()
+
+""" Handles one client connection, one sentence per line """
+class _LineHandler(SocketServer.StreamRequestHandler):
+
+  def handle(self):
+    while True:
+      line = self.rfile.readline()
+      if not line:
+        break
+
+      words = line.split()
+      tags = self.server.batcher.decode(words)
+      if tags is None:
+        self.wfile.write("\n") # decoding failed, but keep the client's lines in step
+      else:
+        self.wfile.write(self.server.PreparserClass.formatOutput(words, tags) + "\n")
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+""" Serve tagging requests until interrupted.
+      viterbi: a ViterbiDecoder of a trained model
+      PreparserClass: preparser whose formatOutput() formats the tagged sentences
+      address: "host:port" for a TCP socket, otherwise the path of a Unix socket
+"""
+def serve(viterbi, PreparserClass, address, log=sys.stderr):
+  host, sep, port = address.rpartition(":")
+  if sep and port.isdigit():
+    server = _TCPServer((host or "localhost", int(port)), _LineHandler)
+  else:
+    if os.path.exists(address): # stale socket from a previous server
+      os.remove(address)
+    server = _UnixServer(address, _LineHandler)
+
+  server.batcher = MicroBatcher(viterbi, log=log)
+  server.PreparserClass = PreparserClass
+
+  # stop cleanly on SIGTERM as well as on ^C:
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+  log.write("Serving on %s\n" % address)
+  log.flush()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    server.batcher.reportStats()
+    if isinstance(server, _UnixServer):
+      os.remove(address)
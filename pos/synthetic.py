@@ -0,0 +1,55 @@
+# Synthetic corpora, sampled from a random HMM, for benchmarking at any tagset and vocabulary size
+import numpy as np
+
+from hmm import STOP
+
+DFLT_ZIPF_EXPONENT = 1.1 # how skewed the words each tag emits are, as in natural text
+DFLT_TRANSITION_CONCENTRATION = 0.1 # Dirichlet concentration of each tag's transitions: small is sparse
+# endings for the words, so that the unkers' rules have something to match (IAST, as in unk.py):
+SUFFIXES = ["", "s", "ed", "ing", "ly", "asya", "ena", "\xe1\xb9\xa3u", "a\xe1\xb8\xa5", "\xc4\x81\xe1\xb8\xa5",
+            "am", "\xc4\x81m", "au", "i\xe1\xb8\xa5", "\xc4\x81t", "at", "tv\xc4\x81", "\xc4\x81", "e", "i", "\xc4\xab"]
+
+""" A random HMM over numTags tags and vocabSize words, to sample tagged sentences from.
+    Each tag follows others by a sparse (Dirichlet) distribution, and emits words with a Zipfian
+     distribution over its own ranking of the vocabulary, so that tags share (ambiguous) words.
+    The same seed gives the same model, and the same samples.
+"""
+class SyntheticHMM:
+
+  def __init__(self, numTags, vocabSize, seed=0):
+    self._rng = np.random.RandomState(seed)
+    self._tags = ["T%i" % y for y in xrange(numTags)]
+    self._words = ["w%i%s" % (x, SUFFIXES[x % len(SUFFIXES)]) for x in xrange(vocabSize)]
+
+    concentration = np.full(numTags, DFLT_TRANSITION_CONCENTRATION)
+    self._start = self._rng.dirichlet(concentration) # the tag of a sentence's first word
+    self._sigma = self._rng.dirichlet(concentration, numTags) # [y,y'] -> proba
+    self._sigmaCdf = np.cumsum(self._sigma, axis=1)
+
+    # the rth most likely word of tag y is perm[(r + offsets[y]) % V]:
+    ranks = np.arange(1, vocabSize+1, dtype=float)**-DFLT_ZIPF_EXPONENT
+    self._rankCdf = np.cumsum(ranks/ranks.sum())
+    self._perm = self._rng.permutation(vocabSize)
+    self._offsets = self._rng.randint(0, vocabSize, numTags)
+
+  """ Sample a sentence of n words. Return: (words, tags) as lists """
+  def _sample(self, n):
+    ys = np.empty(n, dtype=np.intp)
+    u = self._rng.random_sample(n)
+    ys[0] = min(np.searchsorted(np.cumsum(self._start), u[0]), len(self._tags)-1)
+    for i in xrange(1, n):
+      ys[i] = min(np.searchsorted(self._sigmaCdf[ys[i-1]], u[i]), len(self._tags)-1)
+
+    ranks = np.minimum(np.searchsorted(self._rankCdf, self._rng.random_sample(n)), len(self._perm)-1)
+    xs = self._perm[(ranks + self._offsets[ys]) % len(self._perm)]
+    return [self._words[x] for x in xs], [self._tags[y] for y in ys]
+
+  """ Yield numSentences sampled (words, tags), without STOPs, of about meanLength words each """
+  def sample(self, numSentences, meanLength):
+    lengths = 1 + self._rng.poisson(max(meanLength-1, 0), numSentences)
+    for n in lengths:
+      yield self._sample(n)
+
+""" Return sentences as the preparsers give them: (words, tags) with a STOP at either end """
+def withStops(sentences):
+  return [([STOP] + words + [STOP], [STOP] + tags + [STOP]) for words,tags in sentences]
@@ -3,13 +3,20 @@
 
 from collections import defaultdict
 
+from hmm import Corpus
+from hmm.corpus import StreamedCorpus
+
 """ Build unigram counts from a corpus, aka n_w(d)
     Inputs:
-      - document: An input corpus to build counts for
+      - document: An input corpus to build counts for, as sentences or a Corpus
     Returns:
       - A tuple of counts (str->int) aka n_w(d)
 """
 def buildCounts(document):
+  if isinstance(document, (Corpus, StreamedCorpus)): # count the ids rather than the words
+    counts,n_o = document.getCounts()
+    return defaultdict(int, counts), n_o
+
   counts = defaultdict(int) # map string -> int: aka n_w(d)
 
   # Populate n_w(d) aka counts dict
@@ -34,6 +41,44 @@ def buildCorpus(files):
 
   return corpus
 
+""" Streaming alternative to buildCorpus(): the sentences of a list of files, read lazily.
+    Nothing is kept in memory; each iteration over the corpus reads the files again.
+"""
+class CorpusReader:
+
+  def __init__(self, files):
+    self._files = files
+
+  def __iter__(self):
+    for fname in self._files:
+      f = open(fname, 'r')
+      for line in f:
+        yield line
+      f.close()
+
+""" Wraps a function returning a (fresh) iterator so the result can be iterated over
+     more than once, e.g. Reiterable(preparser.iterWords) to make several passes over a corpus.
+"""
+class Reiterable:
+
+  def __init__(self, makeIter):
+    self._makeIter = makeIter
+
+  def __iter__(self):
+    return self._makeIter()
+
+""" Split an iterable into lists of (at most) size consecutive items, lazily """
+def chunked(iterable, size):
+  chunk = []
+  for item in iterable:
+    chunk.append(item)
+    if len(chunk) == size:
+      yield chunk
+      chunk = []
+
+  if chunk:
+    yield chunk
+
 """ Build a tagset, given relevant cmdline args """
 def buildTags(args):
   if args.tagfile:
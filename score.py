@@ -11,7 +11,9 @@ np.set_printoptions(threshold=np.inf,linewidth=77)
 def parseProgramArgs():
   parser = argparse.ArgumentParser(description="Score tagged output.")
   parser.add_argument("gold", help="Gold (correct) output.")
-  parser.add_argument("tagged", help="Tagged output.")
+  parser.add_argument("tagged", nargs='+',
+                      help="Tagged output. Several can be given, e.g. every step of a learning curve, "
+                           "and are each scored against gold, which is only parsed once.")
   parser.add_argument("tagset", help="Tagset file.")
   parser.add_argument("-v", "--verbose", help="Include flag for labels on output values",
                       action="store_true")
@@ -26,46 +28,48 @@ def parseProgramArgs():
 
   return parser.parse_args()
 
+""" Write a line of the report, prefixed by the name of the tagged file if there are several """
+def report(args, fname, line):
+  if len(args.tagged) > 1:
+    sys.stdout.write(fname + " ")
+  print line
+
 if __name__ == '__main__':
 
   args = parseProgramArgs()
 
-  testFile = open(args.gold, 'r')
-  outputFile = open(args.tagged, 'r')
   tagsetFile = open(args.tagset, 'r')
-
-  gold = [line for line in testFile]
-  tagged = [line for line in outputFile]
   tagset = [line.split()[0] for line in tagsetFile]
+  tagsetFile.close()
 
   if args.lang == "EN":
     FilePreparser = preparser.EnglishWSJParser
   elif args.lang == "SANS":
     FilePreparser = preparser.SanskritJNUParser
 
-  if args.confusion or args.balanced:
-    labels, confusion = calculateConfusion(FilePreparser, gold, tagged, tagset)
-    diag = np.diagonal(confusion) # report the diagonal
+  testFile = open(args.gold, 'r')
+  scorer = TagScorer(FilePreparser, testFile, tagset) # files are streamed, not read into memory
+  testFile.close()
 
-    if args.confusion:
-      if args.verbose:
-        print "Diagonal of confusion matrix:"
-      for label,val in zip(labels,diag):
-        print "%s %.6f" % (label,val)
+  for fname in args.tagged:
+    outputFile = open(fname, 'r')
+    accuracy, labels, confusion = scorer.score(outputFile)
+    outputFile.close()
 
-    if args.balanced:
-      if args.verbose:
-        sys.stdout.write("Balanced accuracy: ")
-      print "%.6f" % (np.sum(diag)/len(diag))
+    if args.confusion or args.balanced:
+      diag = np.diagonal(confusion) # report the diagonal
 
-  # report accuracy if flag is explicitly specified, or if others are omitted
-  if not (args.confusion or args.balanced) or args.accuracy:
-    accuracy = calculateAccuracy(FilePreparser, gold, tagged)
-    if args.verbose:
-      sys.stdout.write("Word-level accuracy: ")
-    print accuracy
+      if args.confusion:
+        if args.verbose:
+          report(args, fname, "Diagonal of confusion matrix:")
+        for label,val in zip(labels,diag):
+          report(args, fname, "%s %.6f" % (label,val))
 
-  testFile.close()
-  outputFile.close()
-  tagsetFile.close()
+      if args.balanced:
+        prefix = "Balanced accuracy: " if args.verbose else ""
+        report(args, fname, "%s%.6f" % (prefix, np.sum(diag)/len(diag)))
 
+    # report accuracy if flag is explicitly specified, or if others are omitted
+    if not (args.confusion or args.balanced) or args.accuracy:
+      prefix = "Word-level accuracy: " if args.verbose else ""
+      report(args, fname, "%s%s" % (prefix, accuracy))
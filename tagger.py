@@ -2,115 +2,302 @@
 
 import sys
 import argparse
+import atexit
+import itertools
+import multiprocessing
 
-from pos import hmm, utils, decoder, preparser
+from pos import hmm, utils, decoder, preparser, server, corpuscache, profiling
 
 DFLT_ITER_CAP = 1
 DFLT_ALPHA = 1.0 # for now, this is only hardcoded
+DFLT_CHUNK_SIZE = 256 # num. of test lines handed to a decoding worker at a time
+DFLT_PROFILE_DIR = "debug/profile"
+PHASES = ["parse", "count", "unk", "train", "estep", "mstep", "checkpoint", "decode"] # see --metrics
 
 def parseProgramArgs():
   parser = argparse.ArgumentParser(description="HMM-based part-of-speech tagger. See README.md for detailed documentation")
   group1 = parser.add_argument_group("Data", "Specify input data to the tagger.")
-  group1.add_argument("--train", nargs='+', required=True,
-                      help="Path(s) to training corpora. Format should match model type.")
-  group1.add_argument("--test", nargs='+', required=True,
-                      help="Path(s) to test corpora.")
-  group1.add_argument("--output", required=True, help="Destination path for tagged test output")
+  group1.add_argument("--train", nargs='+',
+                      help="Path(s) to training corpora. Format should match model type. Required unless --load-model is given.")
+  group1.add_argument("--test", nargs='+',
+                      help="Path(s) to test corpora. Required unless --serve is given.")
+  group1.add_argument("--output", help="Destination path for tagged test output. Required unless --serve is given.")
   group1.add_argument("--extra", nargs='+', help="Path to supplementary unlabeled corpus. Required if using semi-supervised, ignored otherwise.")
 
   group2 = parser.add_argument_group("Model types", "Define the model being used.")
   group2.add_argument("--lang", choices=["EN", "SANS"], required=True,
                       help="Select tagging language.")
-  group2.add_argument("--model", choices=["super", "unsuper", "semisuper"], required=True,
-                      help="Train HMM in supervised, unsupervised or semi-supervised fashion.")
+  group2.add_argument("--model", choices=["super", "unsuper", "semisuper"],
+                      help="Train HMM in supervised, unsupervised or semi-supervised fashion. Required unless --load-model is given.")
+  group2.add_argument("--save-model", help="Path to save the trained model to, for use with --load-model.")
+  group2.add_argument("--load-model", help="Path to a model saved with --save-model. Skips preparsing and training.")
 
   group3 = parser.add_argument_group("Meta-parameters", "Tweak meta-parameters to the model.")
   group3.add_argument("--iter", type=int, help="Specify number of iterations of EM (for semi- and unsupervised models). Omit for 1 iteration default.")
+  group3.add_argument("--online", action="store_true",
+                      help="Train with online (stepwise) EM, streaming the unlabeled corpus in minibatches "
+                           "rather than holding it in memory. --iter then counts passes over the corpus.")
+  group3.add_argument("--batch-size", type=int, default=hmm.hidden.DFLT_ONLINE_BATCH,
+                      help="Number of sentences per minibatch of online EM. Defaults to %(default)s.")
+  group3.add_argument("--step-exponent", type=float, default=hmm.hidden.DFLT_STEP_EXPONENT,
+                      help="Online EM weights the k-th minibatch by (k+1)^-STEP_EXPONENT, in (0.5, 1]. "
+                           "Defaults to %(default)s.")
+  group3.add_argument("--em-top", type=int, default=0, metavar="K",
+                      help="Prune the E-step of EM to the K most probable tags of each word, by forward probability. "
+                           "Much faster for large tagsets; the fraction of probability mass pruned is reported.")
+  group3.add_argument("--em-threshold", type=float, default=0.0, metavar="X",
+                      help="Prune the E-step of EM to the tags of each word at least X (in [0,1)) times as "
+                           "probable as its best, by forward probability.")
+  group3.add_argument("--min-improvement", type=float, default=0.0, metavar="X",
+                      help="Stop EM before --iter iterations once an iteration improves the log-likelihood "
+                           "of the corpus by less than X, relative to the previous one (e.g. 1e-4).")
+  group3.add_argument("--checkpoint", metavar="DIR",
+                      help="Save the state of EM to DIR every --checkpoint-every iterations, and after the last.")
+  group3.add_argument("--checkpoint-every", type=int, default=hmm.hidden.DFLT_CHECKPOINT_EVERY, metavar="N",
+                      help="Iterations between checkpoints. Defaults to %(default)s.")
+  group3.add_argument("--resume", action="store_true",
+                      help="Continue EM from the checkpoint in --checkpoint, if any, rather than from the first "
+                           "iteration. The other options must be those of the checkpointed run.")
   group3_mutex = group3.add_mutually_exclusive_group()
   group3_mutex.add_argument("--tagfile", help="Path to file containing a tagset.")
   group3_mutex.add_argument("-n", "--num_tags", type=int, default=1,
                             help="Number of tags the unsupervised model should use.")
 
-  return parser.parse_args()
+  group4 = parser.add_argument_group("Execution", "Control how the tagger runs.")
+  group4.add_argument("-j", "--jobs", type=int, default=1,
+                      help="Number of worker processes to run EM and decode the test corpus with. Defaults to 1.")
+  group4.add_argument("--cache", metavar="DIR",
+                      help="Cache preparsed training corpora in DIR, and reuse them when run again on the same files.")
+  group4.add_argument("--metrics", metavar="FILE",
+                      help="Write telemetry to FILE as JSON lines: the seconds and throughput of each phase "
+                           "(parse, count, unk, train, each E- and M-step of EM, decode), and the log-likelihood of each E-step.")
+  group4.add_argument("--profile", nargs='+', metavar="PHASE", choices=PHASES + ["all"],
+                      help="Profile the given phases (%s, or all), writing each phase's pstats and "
+                           "collapsed stacks (for flamegraphs) to --profile-dir, and printing the hot "
+                           "functions of each at exit." % ", ".join(PHASES))
+  group4.add_argument("--profile-dir", metavar="DIR", default=DFLT_PROFILE_DIR,
+                      help="Directory to write profiles to. Defaults to %s." % DFLT_PROFILE_DIR)
+  group4.add_argument("--profile-top", metavar="N", type=int, default=profiling.DFLT_TOP,
+                      help="Number of hot functions printed per profiled phase. Defaults to %i." % profiling.DFLT_TOP)
+  group4.add_argument("--serve", metavar="ADDRESS",
+                      help="Instead of tagging --test, serve tagging requests on ADDRESS: host:port for TCP, "
+                           "otherwise the path of a Unix socket. Send one sentence per line, receive it tagged.")
 
-def setupVisibleModel(PreparserClass, UnkerClass, corpus):
-  data = PreparserClass(corpus).parseWordsTags()
-  if data is None:
-    sys.stderr.write("Error parsing input: Bad format.\n")
-    sys.exit(1)
+  group5 = parser.add_argument_group("Decoding", "Prune the states Viterbi decoding considers, for speed.")
+  group5.add_argument("--tag-dict", nargs='?', const=hmm.tagdict.DFLT_FALLBACK, choices=hmm.tagdict.FALLBACKS,
+                      help="Restrict each word to the tags it was seen with in --train, and words not seen there "
+                           "to those of their UNK category (category), of any UNK category (open), or to every tag (all). "
+                           "Defaults to %s if given without a value. Requires --model super or semisuper." % hmm.tagdict.DFLT_FALLBACK)
+  group5.add_argument("--beam", type=int, metavar="N",
+                      help="Carry only the N best states of each word forward.")
+  group5.add_argument("--prune-threshold", type=float, metavar="X",
+                      help="Drop the states of each word whose log probability is more than X below the best.")
 
-  words,tags = data
-  counts,wc = utils.buildCounts(words)
-  unker = UnkerClass(words,counts) # construct the unker (for unk substitution)
+  args = parser.parse_args()
+  if not args.load_model and not (args.train and args.model):
+    parser.error("--train and --model are required unless --load-model is given")
+  if not args.serve and not (args.test and args.output):
+    parser.error("--test and --output are required unless --serve is given")
+  if args.tag_dict and (args.load_model or args.model == "unsuper"):
+    parser.error("--tag-dict requires a model trained on --train in this run, with --model super or semisuper")
+  if args.beam is not None and args.beam < 1:
+    parser.error("--beam must be at least 1")
+  if args.resume and not args.checkpoint:
+    parser.error("--resume requires --checkpoint")
+  if args.online and (args.checkpoint or args.min_improvement):
+    parser.error("--checkpoint and --min-improvement are not supported with --online")
+  if args.checkpoint_every < 1:
+    parser.error("--checkpoint-every must be at least 1")
+  if args.batch_size < 1 or not 0.5 < args.step_exponent <= 1.0:
+    parser.error("--batch-size must be at least 1, and --step-exponent in (0.5, 1]")
+  if args.em_top < 0 or not 0.0 <= args.em_threshold < 1.0:
+    parser.error("--em-top must be at least 0, and --em-threshold in [0,1)")
 
-  return words, hmm.VisibleDataHMM(unker, tags, wc)
+  return args
 
-if __name__ == '__main__':
+# Decoding state of a worker process, set once per process by initDecodeWorker()
+_workerState = None
 
-  args = parseProgramArgs()
-  iter_cap = args.iter or DFLT_ITER_CAP
+""" Pool initializer: keep the decoder and preparser for the lifetime of the worker.
+    Workers are forked, so the trained model is inherited once rather than pickled per task.
+"""
+def initDecodeWorker(viterbi, PreparserClass):
+  global _workerState
+  _workerState = (viterbi, PreparserClass)
 
-  trainData = utils.buildCorpus(args.train)
-  testData = utils.buildCorpus(args.test)
+""" Decode a chunk of test lines. Return: (the tagged output lines in the same order, number of words) """
+def decodeChunk(lines):
+  viterbi, PreparserClass = _workerState
+  sentences = [PreparserClass.getSentenceWords(line) for line in lines]
+  tagged = [PreparserClass.formatOutput(sentence, yhat)
+            for sentence,yhat in itertools.izip(sentences, viterbi.decodeBatch(sentences))]
+  return tagged, sum(len(sentence) for sentence in sentences)
 
-  outFile = open(args.output, 'w')
+""" Return the corpus of the given files as a Corpus of word (and if tagged, tag) ids, parsed in
+     one pass or, with --cache, as preparsed by a previous run (see pos.corpuscache).
+    Exits if tagged and a sentence is badly formatted.
+"""
+def loadCorpus(args, files, FilePreparser, UnkerClass, tagged):
+  with hmm.metrics.getMetrics().phase("parse", files=files, cached=bool(args.cache)) as phase:
+    try:
+      if args.cache:
+        corpus = corpuscache.cachedCorpus(files, FilePreparser, UnkerClass, args.cache, tagged)
+      else:
+        corpus = FilePreparser(utils.CorpusReader(files)).parseCorpus(tagged)
+    except ValueError as e:
+      sys.stderr.write("Error parsing input: %s\n" % e)
+      sys.exit(1)
+    phase.count(len(corpus), corpus.numTokens())
 
-  # Determine which preparser to use (this can be extensible)
-  if args.lang == "EN":
-    FilePreparser = preparser.EnglishWSJParser
-    UnkerClass = hmm.unk.BasicUnker
-  elif args.lang == "SANS":
-    FilePreparser = preparser.SanskritJNUParser
-    UnkerClass = hmm.unk.PratyayaUnker
+  return corpus
+
+""" Count the words of a corpus, see utils.buildCounts() """
+def countWords(corpus):
+  with hmm.metrics.getMetrics().phase("count") as phase:
+    counts,wc = utils.buildCounts(corpus)
+    phase.count(tokens=wc)
+
+  return counts,wc
+
+""" Set up a visible model from the Corpus of a labeled corpus, which the unker and model share """
+def setupVisibleModel(corpus, UnkerClass):
+  counts,wc = countWords(corpus)
+  unker = UnkerClass(corpus,counts) # construct the unker (for unk substitution)
+
+  return hmm.VisibleDataHMM(unker, None, wc)
+
+""" Preparse the training corpora given by args and train a model of the type args.model.
+    Return: the model, and the supervised model it was trained from (None if unsupervised)
+    Corpora are encoded as Corpus ids (see loadCorpus()), except that the unlabeled corpus of
+     --online is streamed from disk rather than read into memory, unless it is cached.
+"""
+def trainModel(args, FilePreparser, UnkerClass):
+  iter_cap = args.iter or DFLT_ITER_CAP
 
   # Set up models depending on the type:
   if args.model == "super":
-    _,model = setupVisibleModel(FilePreparser, UnkerClass, trainData)
+    model = visibleModel = setupVisibleModel(loadCorpus(args, args.train, FilePreparser, UnkerClass, True), UnkerClass)
     params = DFLT_ALPHA # alpha smoothing
   elif args.model == "unsuper":
-    words = FilePreparser(trainData).parseWords() # get corpus as list of sentences
-    if words is None:
-      sys.stderr.write("Error parsing input: Bad format.\n")
-
-    counts,wc = utils.buildCounts(words) # build counts dict
+    if args.online and not args.cache:
+      words = hmm.corpus.StreamedCorpus(args.train, FilePreparser)
+    else:
+      words = loadCorpus(args, args.train, FilePreparser, UnkerClass, False) # get corpus as sentences
+    counts,wc = countWords(words) # build counts dict
     tagset = utils.buildTags(args) # build a tagset from either tagfile or int range
     unker = UnkerClass(words,counts)
-    model = hmm.HiddenDataHMM(unker, tagset, wc) # initialise the model
+    model = hmm.HiddenDataHMM(unker, tagset, wc, stream=args.online) # initialise the model
+    visibleModel = None
     params = (iter_cap, None)
   else: # model is semi-supervised
-    words,visibleModel = setupVisibleModel(FilePreparser, UnkerClass, trainData) # now we have a visible model
-    visibleModel.train(DFLT_ALPHA) # build the counts from the visible model
+    labeled = loadCorpus(args, args.train, FilePreparser, UnkerClass, True)
+    visibleModel = setupVisibleModel(labeled, UnkerClass) # now we have a visible model
+    with hmm.metrics.getMetrics().phase("train", model="super"):
+      visibleModel.train(DFLT_ALPHA) # build the counts from the visible model
 
     params = (iter_cap, (visibleModel.getDistribution(), visibleModel.getVisibleCounts()))
     if not args.extra: # make sure the user has specified this option
       sys.stderr.write("--extra must be specified if --model=semisuper\n")
       sys.exit(1)
 
-    unlabeledData = utils.buildCorpus(args.extra)
-    extraWords = FilePreparser(unlabeledData).parseWords() # preparse unlabeled data
-    if extraWords is None:
-      sys.stderr.write("Error parsing extra input: Bad format.\n")
-      sys.exit(1)
+    if args.online and not args.cache:
+      extraWords = hmm.corpus.StreamedCorpus(args.extra, FilePreparser)
+    else:
+      extraWords = loadCorpus(args, args.extra, FilePreparser, UnkerClass, False) # preparse unlabeled data
 
-    counts,wc = utils.buildCounts(extraWords+words) # build counts from the labeled and unlabeled data
+    # build counts from the labeled and unlabeled data (the labeled were counted for the visible model):
+    counts,wc = countWords(extraWords)
+    for word,count in visibleModel.getUnker().getCounts().iteritems():
+      counts[word] += count
+    wc += visibleModel.getWordCount()
     tagset = visibleModel.getLabels() # get the tags from visible data
-    labelMapper = visibleModel.getLabelHash() # get the mapping of label:str -> label:int
 
     # build a new unker whose corpus is only unlabeled data, but whose counts include
     #  those of labeled data:
     unker = UnkerClass(extraWords,counts)
-    model = hmm.HiddenDataHMM(unker, tagset, wc, visibleModel.getLabelHash()) # boom, we got a model
+    model = hmm.HiddenDataHMM(unker, tagset, wc, visibleModel.getLabelHash(),
+                              visibleModel.getVocabulary(), args.online) # boom, we got a model
 
-  model.train(params) # train our model with the given training parameters
+  if args.model != "super":
+    model.setPruning(args.em_threshold, args.em_top)
 
-  viterbi = decoder.ViterbiDecoder(model)
+  # train our model with the given training parameters:
+  with hmm.metrics.getMetrics().phase("train", model=args.model, online=args.online, jobs=args.jobs):
+    if args.model == "super":
+      model.train(params)
+    elif args.online:
+      model.trainOnline(params, args.batch_size, args.step_exponent)
+    else:
+      try:
+        model.train(params, args.jobs, minImprovement=args.min_improvement, checkpoint=args.checkpoint,
+                    checkpointEvery=args.checkpoint_every, resume=args.resume) # the E-step runs on args.jobs processes
+      except (ValueError, IOError) as e:
+        if not args.resume: # only the checkpoint comes from outside this run
+          raise
+        sys.stderr.write("Error resuming from checkpoint %s: %s\n" % (args.checkpoint, e))
+        sys.exit(1)
 
-  # decode the test file:
-  for line in testData:
-    sentence = FilePreparser.getSentenceWords(line)
-    yhat = viterbi.decode(sentence)
-    tagged = FilePreparser.formatOutput(sentence, yhat)
-    outFile.write(tagged+"\n")
+  return model, visibleModel
 
-  outFile.close()
+if __name__ == '__main__':
+
+  args = parseProgramArgs()
+  if args.metrics:
+    hmm.metrics.setMetrics(hmm.metrics.Metrics(open(args.metrics, 'w')))
+  if args.profile:
+    phases = None if "all" in args.profile else args.profile
+    profiler = profiling.PhaseProfiler(phases, args.profile_dir, args.profile_top)
+    hmm.metrics.getMetrics().setProfiler(profiler)
+    atexit.register(profiler.finish) # also on sys.exit(), e.g. after --serve
+    if args.jobs > 1 and (phases is None or "estep" in phases or "decode" in phases):
+      sys.stderr.write("Warning: with --jobs, E-steps and decoding run in worker processes, "
+                       "which aren't profiled. Profile with --jobs 1.\n")
+
+  # Determine which preparser to use (this can be extensible)
+  if args.lang == "EN":
+    FilePreparser = preparser.EnglishWSJParser
+    UnkerClass = hmm.unk.BasicUnker
+  elif args.lang == "SANS":
+    FilePreparser = preparser.SanskritJNUParser
+    UnkerClass = hmm.unk.PratyayaUnker
+
+  visibleModel = None
+  if args.load_model:
+    model = hmm.loadModel(args.load_model) # already trained, nothing to preparse
+  else:
+    model, visibleModel = trainModel(args, FilePreparser, UnkerClass)
+    if args.save_model:
+      hmm.saveModel(model, args.save_model)
+
+  # the tag dictionary comes from the labeled data, whose labels a semi-supervised model keeps:
+  tagDict = hmm.TagDictionary.fromVisible(visibleModel, args.tag_dict) if args.tag_dict else None
+  viterbi = decoder.ViterbiDecoder(model, tagDict, args.beam, args.prune_threshold)
+
+  if args.serve: # keep the model around and tag sentences as they are sent to us
+    server.serve(viterbi, FilePreparser, args.serve)
+    sys.exit(0)
+
+  testData = utils.CorpusReader(args.test)
+  outFile = open(args.output, 'w')
+
+  # decode the test file, in chunks so they can be spread over worker processes:
+  chunks = utils.chunked(testData, DFLT_CHUNK_SIZE)
+  if args.jobs > 1:
+    pool = multiprocessing.Pool(args.jobs, initDecodeWorker, (viterbi, FilePreparser))
+    results = pool.imap(decodeChunk, chunks) # imap yields chunks back in input order
+  else:
+    initDecodeWorker(viterbi, FilePreparser)
+    results = itertools.imap(decodeChunk, chunks)
+
+  with hmm.metrics.getMetrics().phase("decode", jobs=args.jobs) as phase:
+    for tagged,tokens in results:
+      for line in tagged:
+        outFile.write(line+"\n")
+      phase.count(len(tagged), tokens)
 
+    if args.jobs > 1:
+      pool.close()
+      pool.join()
+
+  outFile.close()
+  hmm.metrics.getMetrics().close()
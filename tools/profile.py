@@ -1,5 +1,29 @@
+#!/usr/bin/env python2
+
+# Run from the top of the repository as: python2 -m tools.profile [STATS...]
+
+import sys
+import argparse
 import pstats
 
-p = pstats.Stats('debug/stats')
-p.strip_dirs().sort_stats('tottime').print_stats()
+from pos import profiling
+
+def parseProgramArgs():
+  parser = argparse.ArgumentParser(description="Report the hot functions of cProfile output, e.g. of ./profiler or tagger.py --profile.")
+  parser.add_argument("stats", nargs='*', default=["debug/stats"],
+                      help="pstats files, combined into one report. Defaults to debug/stats.")
+  parser.add_argument("-s", "--sort", default=profiling.DFLT_SORT,
+                      help="pstats sort key, e.g. tottime, cumtime or ncalls. Defaults to %s." % profiling.DFLT_SORT)
+  parser.add_argument("-n", "--top", type=int, help="Number of functions to list. Defaults to all.")
+  parser.add_argument("--collapsed", metavar="FILE",
+                      help="Also write collapsed stacks to FILE, for flamegraph tools.")
+
+  return parser.parse_args()
+
+if __name__ == '__main__':
+  args = parseProgramArgs()
 
+  p = pstats.Stats(*args.stats)
+  if args.collapsed:
+    profiling.writeCollapsed(p, args.collapsed)
+  profiling.printTop(p, args.top, args.sort)
@@ -1,6 +1,7 @@
-import itertools
+import array
 import numpy as np
-from collections import defaultdict
+
+from pos.hmm.corpus import ranges
 
 """Map the association between a pos label and its integer index.
    Necessary because hmms store labels as ints for faster indexing on numpy arrays,
@@ -13,56 +14,80 @@ def makeLabelHash(labels):
 
  return labelHash
 
+""" Scores tagged output against a gold file, with the gold tags parsed once, so that many
+     tagged outputs (e.g. every step of a learning curve) can be scored against it.
+    Tags are kept as flat arrays of label ids, and files are read a line at a time, so
+     neither the gold nor the tagged lines need be held in memory.
+"""
+class TagScorer:
+
+  """ filePreparser: the preparser whose getSentenceTags() parses a line of either file
+      gold: the lines of the gold file, any iterable e.g. the open file
+      tagset: (optional) the classes of the confusion matrix. If empty, the classes are those
+              present in the gold and tagged lines of each scored output.
+  """
+  def __init__(self, filePreparser, gold, tagset=None):
+    self._preparser = filePreparser
+    self._tagset = list(tagset) if tagset else None
+    self._labels = list(self._tagset or []) # every label seen so far, by id
+    self._labelHash = makeLabelHash(self._labels)
+    self._gold, self._goldOffsets = self._encode(gold)
+
+  """ Return the id of a label, giving it the next id if it is new """
+  def _labelId(self, y):
+    i = self._labelHash.get(y)
+    if i is None:
+      i = self._labelHash[y] = len(self._labels)
+      self._labels.append(y)
+    return i
+
+  """ Return the label ids of every line end to end, and the offsets of each line in them """
+  def _encode(self, lines):
+    ids, lengths = array.array('i'), array.array('l', [0])
+    for line in lines:
+      tags = self._preparser.getSentenceTags(line)
+      ids.extend([self._labelId(y) for y in tags])
+      lengths.append(len(tags))
+
+    return np.frombuffer(ids, dtype=np.int32), np.cumsum(np.frombuffer(lengths, dtype=np.int_))
+
+  """ Score the lines of a tagged file (any iterable) against the gold lines, line by line.
+      Return: (accuracy, labels, confusion) where confusion[i,j] is the fraction of the gold
+       labels[i] tagged as labels[j].
+      As before, a line only counts towards accuracy if it has as many tags as its gold line,
+       and the confusion matrix pairs up the tags the two lines have in common.
+  """
+  def score(self, tagged):
+    pred, predOffsets = self._encode(tagged)
+    n = min(len(self._goldOffsets), len(predOffsets)) - 1 # lines beyond the shorter file are ignored
+    goldLengths = np.diff(self._goldOffsets[:n+1])
+    predLengths = np.diff(predOffsets[:n+1])
+    paired = np.minimum(goldLengths, predLengths)
+
+    ys = self._gold[ranges(self._goldOffsets[:n], paired)]
+    yhats = pred[ranges(predOffsets[:n], paired)]
+    matched = np.repeat(goldLengths == predLengths, paired) # tags of lines whose lengths match
+
+    total = predLengths.sum()
+    accuracy = np.count_nonzero((ys == yhats) & matched)/float(total) if total else 0.0
+
+    T = len(self._labels)
+    counts = np.bincount(ys.astype(np.int64)*T + yhats, minlength=T*T).reshape(T,T).astype(float)
+    if self._tagset:
+      classes = np.arange(len(self._tagset))
+    else:
+      classes = np.flatnonzero(np.bincount(ys, minlength=T) + np.bincount(yhats, minlength=T))
+
+    # ignore divide by 0 and make it 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+      norm = np.sum(counts, axis=1).reshape(T,1)
+      confusion = np.nan_to_num(counts/norm)
+
+    return accuracy, [self._labels[i] for i in classes], confusion[np.ix_(classes, classes)]
+
 def calculateAccuracy(filePreparser, correctFile, estimateFile):
-  numCorrect = 0.0
-  total = 0.0
-  for correct,estimate in itertools.izip(correctFile, estimateFile):
-    correctTags = filePreparser.getSentenceTags(correct)
-    estimateTags = filePreparser.getSentenceTags(estimate)
-    total += len(estimateTags)
-    if len(correctTags) == len(estimateTags):
-      for i in xrange(0, len(correctTags)):
-        if correctTags[i] == estimateTags[i]:
-          numCorrect += 1.0
-
-  if total == 0.0:
-    return 0.0
-
-  return numCorrect/total
+  return TagScorer(filePreparser, correctFile).score(estimateFile)[0]
 
 """ Computes the confusion matrix for the tagged output """
 def calculateConfusion(filePreparser, gold, tagged, tagset=None):
-  confusionCounts = defaultdict(int) # (ygold,ypred)->count
-  labels = set()
-
-  for correct,estimate in itertools.izip(gold, tagged):
-    correctTags = filePreparser.getSentenceTags(correct)
-    estimateTags = filePreparser.getSentenceTags(estimate)
-
-    for i,y in enumerate(correctTags):
-      actual = y
-      predicted = estimateTags[i]
-      confusionCounts[(actual,predicted)] += 1.0 # actual is labeled as predicted
-      labels.add(actual)
-      labels.add(predicted)
-
-  if tagset:
-    labels = list(tagset)
-  else:
-    labels = list(labels)
-
-  labelHash = makeLabelHash(labels)
-  n = len(labels)
-  confusionMat = np.zeros([n]*2) # nxn matrix of confusion
-  for dazed,confused in confusionCounts.iteritems():
-    actual,predicted = dazed
-    ygold,ypred = labelHash[actual], labelHash[predicted]
-    confusionMat[ygold,ypred] = confused
-
-  # ignore divide by 0 and make it 0
-  with np.errstate(divide='ignore', invalid='ignore'):
-    norm = np.sum(confusionMat, axis=1).reshape(n,1)
-    confusionMat = confusionMat/norm
-
-  return labels, np.nan_to_num(confusionMat)
-
+  return TagScorer(filePreparser, gold, tagset).score(tagged)[1:]